@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import json
+import argparse
+
+from lib.benchmark import Benchmark
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the Job Queue Manager end to end against a stand-in Frontend API and local clients'
+)
+
+parser.add_argument('-n', '--files', action='store', dest='files', type=int, default=1000
+                    , help='Files in the synthetic package')
+parser.add_argument('-s', '--size', action='store', dest='size', type=int, default=64 * 1024
+                    , help='Size of each file in bytes')
+parser.add_argument('-a', '--action', action='append', dest='actions', choices=Benchmark.ACTIONS
+                    , help='Job action to run (may be repeated), defaults to all of them')
+parser.add_argument('-r', '--repeat', action='store', dest='repeat', type=int, default=1
+                    , help='Times to run each action')
+parser.add_argument('-e', '--engine', action='store', dest='engine', choices=['process', 'asyncio']
+                    , help='Job engine, defaults to the config file\'s (or the default) engine')
+parser.add_argument('-m', '--transfer-mode', action='store', dest='transfer_mode', choices=['file', 'package']
+                    , help='Transfer mode, defaults to the config file\'s (or the default) mode')
+parser.add_argument('-t', '--timeout', action='store', dest='timeout', type=float, default=Benchmark.TIMEOUT
+                    , help='Seconds a job gets before its run is given up on and reported as failed')
+parser.add_argument('-c', '--config', action='store', dest='config_file'
+                    , help='Configuration file to take the settings (bar the daemon and API ones) from')
+parser.add_argument('-d', '--dir', action='store', dest='root'
+                    , help='Empty (or new) directory to hold the clients in, its contents are removed afterwards'
+                           ', defaults to a temporary directory')
+parser.add_argument('-j', '--json', action='store_true', dest='json'
+                    , help='Print the measurements as JSON')
+
+
+def report(results):
+    """ Print a line per run, followed by the API calls made by endpoint """
+    columns = '{0:<6} {1:<5} {2:>9} {3:>9} {4:>8} {5:>11} {6:>9} {7:>9}'
+    print(columns.format('action', 'state', 'wall (s)', 'api calls', 'spawned', 'hashed (MB)', 'rss (MB)',
+                         'jobs (MB)'))
+
+    for result in results:
+        print(columns.format(result['action'], result['state'], '{0:.2f}'.format(result['wall']),
+                             result['api_calls'], result['spawned'], '{0:.1f}'.format(result['hashed'] / 2 ** 20),
+                             '{0:.1f}'.format(result['peak_rss'] / 2 ** 20),
+                             '{0:.1f}'.format(result['peak_child_rss'] / 2 ** 20)))
+
+    for result in results:
+        print('{0}: {1}'.format(result['action'], ', '.join('{0}={1}'.format(endpoint, calls) for endpoint, calls
+                                                           in sorted(result['api_calls_by_endpoint'].items()))))
+
+
+def main():
+    """ Parse the command-line options and run the benchmark """
+
+    args = parser.parse_args()
+
+    benchmark = Benchmark(args.root, args.files, args.size, config_file=args.config_file, engine=args.engine,
+                          transfer_mode=args.transfer_mode, timeout=args.timeout)
+    results = benchmark.run_all(args.actions or Benchmark.ACTIONS, args.repeat)
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        report(results)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,17 @@
 #!/usr/bin/env python3
 
+import os
 import json
+import time
 import requests
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from lib import metrics
+from lib.cache import LruCache
+from lib.config import ConfigManager
+
 
 class ApiManager():
     """ Handles all interactions with the API """
@@ -10,50 +19,174 @@ class ApiManager():
     DEFAULT_PARAMS = dict()
     DEFAULT_HEADERS = dict(JSON_HEADER)
 
-    def __init__(self, host):
+    # Server side hiccups worth retrying, anything else is returned to the caller as is
+    RETRY_STATUSES = (500, 502, 503, 504)
+    RETRY_METHODS = frozenset(['HEAD', 'GET', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'])
+
+    def __init__(self, host, api_config=None):
         """ Setup the API connection """
         self.host = host
 
-    # API Operations
-    def get(self, endpoint, params=None, headers=None):
-        """ Returns the request response, a list() of objects your getting or the error response """
+        if api_config is None:
+            api_config = ConfigManager.default_section(ConfigManager.API)
+
+        self.pool_size = int(api_config.pool_size)
+        self.timeout = (float(api_config.connect_timeout), float(api_config.read_timeout))
+        self.retries = int(api_config.retries)
+        self.backoff_factor = float(api_config.backoff_factor)
+
+        # endpoint -> {'calls': int, 'errors': int, 'total': seconds, 'max': seconds}
+        self.latency = dict()
+
+        self._session = None
+        self._session_pid = None
+
+    @property
+    def session(self):
+        """
+        Returns the keep-alive session of this process
+        A forked job must not share the parent's sockets, so it gets a fresh session on first use
+        """
+        if self._session is None or self._session_pid != os.getpid():
+            self._session = self.build_session()
+            self._session_pid = os.getpid()
+            self.latency = dict()
+
+        return self._session
+
+    def build_session(self):
+        """ Build a pooled session that retries connection errors and server hiccups with backoff """
+        retry = Retry(total=self.retries, backoff_factor=self.backoff_factor, status_forcelist=self.RETRY_STATUSES,
+                      allowed_methods=self.RETRY_METHODS, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        return session
+
+    def close(self):
+        """ Close down the pooled connections of this process """
+        if self._session is not None and self._session_pid == os.getpid():
+            self._session.close()
+
+        self._session = None
+
+    def record_latency(self, endpoint, elapsed, failed):
+        """ Add the call to the latency counters of the endpoint (ignoring any object id) """
+        counters = self.latency.setdefault(endpoint.split('/')[0], {'calls': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+        metrics.registry.observe('jqm_api_request_seconds', elapsed, endpoint=endpoint.split('/')[0],
+                                 outcome='error' if failed else 'ok')
+
+        counters['calls'] += 1
+        counters['total'] += elapsed
+        counters['max'] = max(counters['max'], elapsed)
+
+        if failed:
+            counters['errors'] += 1
+
+    def latency_stats(self):
+        """ Returns a dict() of endpoint -> call count, error count, mean and max latency in seconds """
+        return {endpoint: {'calls': counters['calls'],
+                           'errors': counters['errors'],
+                           'mean': counters['total'] / counters['calls'],
+                           'max': counters['max']}
+                for endpoint, counters in self.latency.items()}
+
+    def request(self, method, endpoint, params=None, headers=None, data=None, timeout=None, stream=False,
+                session=None):
+        """
+        Send the request down the pooled session (or the session given) and returns the raw response
+        A timeout of None uses the configured (connect, read) timeouts
+        """
         if not params:
             params = self.DEFAULT_PARAMS
         if not headers:
             headers = self.DEFAULT_HEADERS
+        if data is not None:
+            data = json.dumps(data)
 
         url = '/'.join([self.host, endpoint, ''])
-        return requests.get(url=url, params=params, headers=headers).json()
+        session = session or self.session
+        started = time.time()
+        failed = True
+
+        try:
+            response = session.request(method, url, params=params, headers=headers, data=data,
+                                       timeout=timeout or self.timeout, stream=stream)
+            failed = not response.ok
+        finally:
+            self.record_latency(endpoint, time.time() - started, failed)
+
+        return response
+
+    # API Operations
+    def get(self, endpoint, params=None, headers=None):
+        """ Returns the request response, a list() of objects your getting or the error response """
+        return self.request('GET', endpoint, params=params, headers=headers).json()
 
     def post(self, endpoint, data, params=None, headers=None):
         """ Returns the request response, either the modified object or the error response """
-        if not params:
-            params = self.DEFAULT_PARAMS
-        if not headers:
-            headers = self.DEFAULT_HEADERS
-
-        url = '/'.join([self.host, endpoint, ''])
-        return requests.post(url=url, params=params, data=json.dumps(data), headers=headers).json()
+        return self.request('POST', endpoint, params=params, headers=headers, data=data).json()
 
     def patch(self, endpoint, data, params=None, headers=None):
         """ Returns the request response, either the modified object or the error response """
-        if not params:
-            params = self.DEFAULT_PARAMS
-        if not headers:
-            headers = self.DEFAULT_HEADERS
-
-        url = '/'.join([self.host, endpoint, ''])
-        return requests.patch(url=url, params=params, data=json.dumps(data), headers=headers).json()
+        return self.request('PATCH', endpoint, params=params, headers=headers, data=data).json()
 
     def head(self, endpoint, params=None, headers=None):
         """ Returns the request response, dict() of headers """
-        if not params:
-            params = self.DEFAULT_PARAMS
-        if not headers:
-            headers = self.DEFAULT_HEADERS
+        return dict(self.request('HEAD', endpoint, params=params, headers=headers).headers)
 
-        url = '/'.join([self.host, endpoint, ''])
-        return requests.head(url=url, params=params, headers=headers).json()
+
+class PackageFile():
+    """ Compact record of a package file, read like the API's dict() (package_file['id'] etc) """
+    __slots__ = ('id', 'relative_path', 'file_hash', 'file_size')
+
+    def __init__(self, id, relative_path, file_hash, file_size=None):
+        self.id = id
+        self.relative_path = relative_path
+        self.file_hash = file_hash
+        self.file_size = file_size
+
+    @classmethod
+    def from_api(cls, package_file):
+        """ Returns the record of the API's package file dict(), file_size being None if the API doesn't say """
+        return cls(package_file['id'], package_file['relative_path'], package_file['file_hash'],
+                   package_file.get('file_size'))
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __setstate__(self, state):
+        for field, value in zip(self.__slots__, state):
+            setattr(self, field, value)
+
+    def __repr__(self):
+        return 'PackageFile(id={0}, relative_path={1!r})'.format(self.id, self.relative_path)
+
+
+class PackageFiles():
+    """ The files of a package, paged in off the API every time they are iterated over """
+
+    def __init__(self, api_manager, package_id):
+        self.api_manager = api_manager
+        self.package_id = package_id
+
+    def __iter__(self):
+        return self.api_manager.iter_package_files(self.package_id)
+
+    def __repr__(self):
+        return 'PackageFiles(package={0})'.format(self.package_id)
 
 
 class FrontendApiManager(ApiManager):
@@ -66,33 +199,69 @@ class FrontendApiManager(ApiManager):
     ENDPOINT_PACKAGEAVAILABILITY = 'packageavailability'
     ENDPOINT_PACKAGEFILEAVAILABILITY = 'fileavailability'
 
+    # Most ids we put into a single '__in' filter, keeps the query string to a sane length
+    BULK_FILTER_SIZE = 100
+    # Most objects we create/update in a single bulk request
+    BULK_WRITE_SIZE = 500
+
     def __init__(self, api_config, logger=None):
         """ Instantiate the Frontend specific vars """
         for var in ['host', 'token']:
             if not hasattr(api_config, var):
                 raise Exception('Config file is missing \'{0}\' in the API section'.format(var))
 
-        ApiManager.__init__(self, api_config.host)
+        ApiManager.__init__(self, api_config.host, api_config=api_config)
 
         self.logger = logger
+        self.page_size = int(api_config.page_size)
         self.DEFAULT_HEADERS['Authorization'] = 'Token {0}'.format(api_config.token)
 
-    def get_job_queue(self):
-        """ Returns the pending job queue """
+        # (endpoint, client id, package/package_file id) -> (availability object id, last reported availability)
+        self.availability_cache = LruCache(int(api_config.availability_cache_size),
+                                           path=api_config.availability_cache_file or None)
+
+    def get_job_queue(self, skip_job_ids=()):
+        """
+        Returns the pending job queue
+        Jobs in skip_job_ids (already being processed) are returned without fetching their package's files
+        """
 
         params = dict(self.DEFAULT_PARAMS)
         params.update({'state': 'PEND'})
         queue = self.get(self.ENDPOINT_JOBS, params=params)
 
-        # Add in the package's files
-        for job in queue:
-            job['package']['package_files'] = list()
+        return self.prepare_job_queue(queue, skip_job_ids)
 
-            params = dict(self.DEFAULT_PARAMS)
-            params.update({'package': job['package']['id']})
+    def long_poll_job_queue(self, etag, wait):
+        """
+        Asks for the pending jobs, the server holding on to the request for up to wait seconds
+        until the queue differs from the one we have (etag)
+        Returns (etag, jobs), jobs being None if the queue hasn't changed
+        """
+        params = dict(self.DEFAULT_PARAMS)
+        params.update({'state': 'PEND', 'wait': wait})
+
+        headers = dict(self.DEFAULT_HEADERS)
+        if etag:
+            headers['If-None-Match'] = etag
+
+        # Give the server the whole wait before we give up on the read
+        response = self.request('GET', self.ENDPOINT_JOBS, params=params, headers=headers,
+                                timeout=(self.timeout[0], self.timeout[1] + wait))
+
+        if response.status_code == 304:
+            return etag, None
+
+        return response.headers.get('ETag'), response.json()
 
-            for package_file in self.get(self.ENDPOINT_FILES, params=params):
-                job['package']['package_files'].append(package_file)
+    def prepare_job_queue(self, queue, skip_job_ids=()):
+        """
+        Name the jobs and add in the files of the packages of the jobs we aren't processing yet
+        The files are paged in off the API as they are iterated over, never all held at once
+        """
+        for job in queue:
+            if job['id'] not in skip_job_ids:
+                job['package']['package_files'] = PackageFiles(self, job['package']['id'])
 
             job['name'] = '{action} - {package}: {source} -> {destination}'.format(
                 action=job['action'],
@@ -102,49 +271,173 @@ class FrontendApiManager(ApiManager):
 
         return queue
 
+    @staticmethod
+    def related_id(related):
+        """ Related objects may come back nested or as just their id """
+        if isinstance(related, dict):
+            return related['id']
+        return related
+
+    def iter_package_files(self, package_id):
+        """
+        Yields the PackageFile's of the package, asking for page_size files per request
+        A server that doesn't paginate hands back the whole list at once
+        """
+        offset = 0
+
+        while True:
+            params = dict(self.DEFAULT_PARAMS)
+            params.update({'package__in': package_id, 'limit': self.page_size, 'offset': offset})
+            page = self.get(self.ENDPOINT_FILES, params=params)
+
+            results = page['results'] if isinstance(page, dict) else page
+            for package_file in results:
+                yield PackageFile.from_api(package_file)
+
+            if not isinstance(page, dict) or not page.get('next') or not results:
+                return
+
+            offset += len(results)
+
     def associate_client_with_package(self, client_id, package_id, available):
         """
         For the given client_id and package_id
         We tie the client to the package
         """
-        # Get all packages that are already tied to the client
-        params = dict(self.DEFAULT_PARAMS)
-        params.update({'client': client_id, 'package': package_id})
-        client_package_instance = self.get(self.ENDPOINT_PACKAGEAVAILABILITY, params=params)
-
-        data = {'availability': available}
-
-        if client_package_instance:
-            # This package is already tied to the client, just update it's availability
-            endpoint = '/'.join([self.ENDPOINT_PACKAGEAVAILABILITY, str(client_package_instance[0]['id'])])
-            return self.patch(endpoint, data, params=self.DEFAULT_PARAMS)
-        else:
-            # This package isn't tied to the client, insert a new entry
-            data['client'] = client_id
-            data['package'] = package_id
-            return self.post(self.ENDPOINT_PACKAGEAVAILABILITY, data, params=self.DEFAULT_PARAMS)
+        return self.associate_client(self.ENDPOINT_PACKAGEAVAILABILITY, 'package', client_id, package_id, available)
 
     def associate_client_with_file(self, client_id, package_file_id, availability):
         """
         For the given client_id and file_id
         We tie the client to the package file
         """
-        # Get all files that are already tied to the client, we update the DEFAULT_PARAMS for filtering
-        params = dict(self.DEFAULT_PARAMS)
-        params.update({'client': client_id, 'package_file': package_file_id})
-        client_package_file_instance = self.get(self.ENDPOINT_PACKAGEFILEAVAILABILITY)
+        return self.associate_client(self.ENDPOINT_PACKAGEFILEAVAILABILITY, 'package_file', client_id,
+                                     package_file_id, availability)
 
+    def associate_client(self, endpoint, related_field, client_id, related_id, availability):
+        """
+        Set the availability of the related object (package/package_file) on the client
+        The id of the availability object is cached, so we only PATCH (or do nothing if the availability
+        hasn't changed). We fall back to looking it up if it's not cached or the server rejects the cached id
+        """
+        key = (endpoint, client_id, related_id)
         data = {'availability': availability}
 
-        if client_package_file_instance:
-            # This package file is already tied to the client, just update it's availability
-            endpoint = '/'.join([self.ENDPOINT_PACKAGEFILEAVAILABILITY, str(client_package_file_instance[0]['id'])])
-            return self.patch(endpoint, data, params=self.DEFAULT_PARAMS)
+        cached = self.availability_cache.get(key)
+        if cached:
+            instance_id, cached_availability = cached
+            if cached_availability == availability:
+                return {'id': instance_id, 'client': client_id, related_field: related_id,
+                        'availability': availability}
+
+            response = self.request('PATCH', '/'.join([endpoint, str(instance_id)]), data=data)
+            if response.ok:
+                self.availability_cache.set(key, (instance_id, availability))
+                return response.json()
+
+            # The object has gone away from under us, forget it and look it up again
+            self.availability_cache.pop(key)
+
+        # Get the availability objects already tied to the client
+        params = dict(self.DEFAULT_PARAMS)
+        params.update({'client': client_id, related_field: related_id})
+        client_instance = self.get(endpoint, params=params)
+
+        if client_instance:
+            # This object is already tied to the client, just update it's availability
+            instance = self.patch('/'.join([endpoint, str(client_instance[0]['id'])]), data,
+                                  params=self.DEFAULT_PARAMS)
         else:
-            # This package file isn't tied to the client, insert a new entry
+            # This object isn't tied to the client, insert a new entry
             data['client'] = client_id
-            data['package_file'] = package_file_id
-            return self.post(self.ENDPOINT_PACKAGEFILEAVAILABILITY, data, params=self.DEFAULT_PARAMS)
+            data[related_field] = related_id
+            instance = self.post(endpoint, data, params=self.DEFAULT_PARAMS)
+
+        if 'id' in instance:
+            self.availability_cache.set(key, (instance['id'], availability))
+
+        return instance
+
+    def availability_reporter(self):
+        """ Returns a reporter that batches up file availability changes """
+        return AvailabilityReporter(self)
+
+    def get_file_availability(self, client_id, package_file_ids):
+        """
+        Returns a dict() of package_file id -> existing fileavailability object for the client
+        Looks up BULK_FILTER_SIZE files per request
+        """
+        package_file_ids = sorted(package_file_ids)
+        availability = dict()
+
+        for i in range(0, len(package_file_ids), self.BULK_FILTER_SIZE):
+            params = dict(self.DEFAULT_PARAMS)
+            params.update({'client': client_id,
+                           'package_file__in': ','.join(str(package_file_id) for package_file_id in
+                                                        package_file_ids[i:i + self.BULK_FILTER_SIZE])})
+
+            for instance in self.get(self.ENDPOINT_PACKAGEFILEAVAILABILITY, params=params):
+                availability[self.related_id(instance['package_file'])] = instance
+
+        return availability
+
+    def bulk_update_file_availability(self, updates):
+        """
+        Updates many existing fileavailability objects, BULK_WRITE_SIZE per request
+        updates is a list() of {'id': ..., 'availability': ...}
+        Returns the updates that the server rejected
+        """
+        rejected = list()
+
+        for i in range(0, len(updates), self.BULK_WRITE_SIZE):
+            chunk = updates[i:i + self.BULK_WRITE_SIZE]
+            if not self.request('PATCH', self.ENDPOINT_PACKAGEFILEAVAILABILITY, data=chunk).ok:
+                rejected.extend(chunk)
+
+        return rejected
+
+    def bulk_create_file_availability(self, creates):
+        """
+        Creates many fileavailability objects, BULK_WRITE_SIZE per request
+        creates is a list() of {'client': ..., 'package_file': ..., 'availability': ...}
+        A batch the server doesn't hand back a list of created objects for is created one object at a time
+        Returns the created objects
+        """
+        created = list()
+
+        for i in range(0, len(creates), self.BULK_WRITE_SIZE):
+            chunk = creates[i:i + self.BULK_WRITE_SIZE]
+            response = self.request('POST', self.ENDPOINT_PACKAGEFILEAVAILABILITY, data=chunk)
+            try:
+                instances = response.json() if response.ok else None
+            except ValueError:
+                instances = None
+
+            if isinstance(instances, list):
+                created.extend(instances)
+                continue
+
+            if self.logger:
+                self.logger.warning('Bulk create of {0} file availabilities failed (HTTP {1}), creating them one at '
+                                    'a time'.format(len(chunk), response.status_code))
+
+            for create in chunk:
+                try:
+                    instance = self.create_file_availability(create)
+                except ValueError:
+                    instance = None
+
+                if isinstance(instance, dict) and 'id' in instance:
+                    created.append(instance)
+                elif self.logger:
+                    self.logger.error('Unable to create the availability of file {0} on client {1} ({2})'.format(
+                        create['package_file'], create['client'], instance))
+
+        return created
+
+    def create_file_availability(self, create):
+        """ Creates a single fileavailability object, returns the created object or the error response """
+        return self.post(self.ENDPOINT_PACKAGEFILEAVAILABILITY, create, params=self.DEFAULT_PARAMS)
 
     def update_job_state(self, job_id, state):
         """
@@ -160,3 +453,103 @@ class FrontendApiManager(ApiManager):
         data = {'state': state}
 
         return self.patch(endpoint, data)
+
+    def update_job_progress(self, job_id, progress):
+        """
+        For the given job_id, update it's progress
+        progress being a dict() of the percent done ('progress'), bytes/s ('rate') and seconds left ('eta')
+        """
+        endpoint = '/'.join([self.ENDPOINT_JOBS, str(job_id)])
+
+        return self.patch(endpoint, progress)
+
+
+class AvailabilityReporter():
+    """
+    Collects the file availability found during a verification and reports it to the API in bulk
+    Existing objects are looked up in one go, unchanged ones are left alone and the rest
+    are created/updated in chunked bulk requests
+    """
+
+    def __init__(self, api_manager):
+        """ Setup the pending (client_id, package_file_id) -> availability reports """
+        self.api_manager = api_manager
+        self.pending = dict()
+
+    def add(self, client_id, package_file_id, availability):
+        """ Queue up the availability of a file on a client, a later report for the same file wins """
+        self.pending[(client_id, package_file_id)] = availability
+
+    def flush(self):
+        """ Send all the pending reports, returns the number of objects written """
+        by_client = dict()
+        for (client_id, package_file_id), availability in self.pending.items():
+            by_client.setdefault(client_id, dict())[package_file_id] = availability
+        self.pending = dict()
+
+        written = 0
+        for client_id, reports in by_client.items():
+            written += self.write(client_id, reports)
+
+        return written
+
+    def cache_key(self, client_id, package_file_id):
+        """ Key of the file's availability object in the api manager's availability cache """
+        return self.api_manager.ENDPOINT_PACKAGEFILEAVAILABILITY, client_id, package_file_id
+
+    def write(self, client_id, reports, retry=True):
+        """ Create/update the client's availability objects that changed, returns the number of objects written """
+        cache = self.api_manager.availability_cache
+
+        # package_file id -> (availability object id, availability), only looking up the ones we don't know
+        existing = dict()
+        lookup = list()
+        for package_file_id in reports:
+            cached = cache.get(self.cache_key(client_id, package_file_id))
+            if cached:
+                existing[package_file_id] = cached
+            else:
+                lookup.append(package_file_id)
+
+        if lookup:
+            for package_file_id, instance in self.api_manager.get_file_availability(client_id, lookup).items():
+                existing[package_file_id] = (instance['id'], instance['availability'])
+                cache.set(self.cache_key(client_id, package_file_id), existing[package_file_id])
+
+        updates = list()
+        creates = list()
+        for package_file_id, availability in reports.items():
+            if package_file_id not in existing:
+                creates.append({'client': client_id, 'package_file': package_file_id, 'availability': availability})
+            elif existing[package_file_id][1] != availability:
+                updates.append({'id': existing[package_file_id][0], 'availability': availability,
+                                'package_file': package_file_id})
+
+        written = 0
+        if updates:
+            rejected = self.api_manager.bulk_update_file_availability(updates)
+            rejected_ids = set(update['package_file'] for update in rejected)
+
+            for update in updates:
+                if update['package_file'] not in rejected_ids:
+                    cache.set(self.cache_key(client_id, update['package_file']), (update['id'], update['availability']))
+                    written += 1
+
+            if rejected_ids:
+                # Something we had cached has gone stale, forget it and try those once more from a fresh lookup
+                for package_file_id in rejected_ids:
+                    cache.pop(self.cache_key(client_id, package_file_id))
+                if retry:
+                    written += self.write(client_id, dict((package_file_id, reports[package_file_id])
+                                                          for package_file_id in rejected_ids), retry=False)
+
+        if creates:
+            # Only what the server actually created counts as written
+            for instance in self.api_manager.bulk_create_file_availability(creates):
+                if 'id' not in instance:
+                    continue
+                cache.set(self.cache_key(client_id, self.api_manager.related_id(instance['package_file'])),
+                          (instance['id'], instance['availability']))
+                written += 1
+
+        return written
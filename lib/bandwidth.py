@@ -0,0 +1,133 @@
+import time
+import datetime
+import contextlib
+import multiprocessing
+
+from lib.config import ConfigManager
+
+
+class BandwidthGovernor():
+    """
+    Shares each client's max_upload/max_download between all the transfers using it at once, across every job
+    rsync's --bwlimit is fixed once rsync starts, so each transfer also draws from a token bucket refilled at its
+    share of the clients' budgets, a share worked out again every time as transfers start and end
+    A transfer that runs out of tokens is paused until it's back within its share
+    """
+
+    # Index into a client's shared counts of the transfers running from/to it
+    UPLOADS = 0
+    DOWNLOADS = 1
+
+    def __init__(self, bandwidth_config=None, logger=None):
+        """ Setup the bucket settings and the rate schedule """
+        if bandwidth_config is None:
+            bandwidth_config = ConfigManager.default_section(ConfigManager.BANDWIDTH)
+
+        self.logger = logger
+        self.enabled = ConfigManager.as_bool(bandwidth_config.governor)
+        self.burst = float(bandwidth_config.burst)
+        self.max_pause = float(bandwidth_config.max_pause)
+        self.schedule = self.parse_schedule(bandwidth_config.schedule)
+
+        # Client id -> shared [uploads, downloads] counts of the transfers running
+        self.active = dict()
+
+    @staticmethod
+    def minute_of_day(clock):
+        """ Takes 'HH:MM', returns the minutes since midnight """
+        hours, minutes = clock.strip().split(':')
+        return int(hours) * 60 + int(minutes)
+
+    @classmethod
+    def parse_schedule(cls, schedule):
+        """ Takes '08:00-18:00=0.5, 18:00-23:00=0.8', returns the list() of (start, end, factor) windows """
+        windows = list()
+
+        for window in filter(None, (window.strip() for window in schedule.split(','))):
+            try:
+                hours, factor = window.split('=')
+                start, end = hours.split('-')
+                windows.append((cls.minute_of_day(start), cls.minute_of_day(end), float(factor)))
+            except ValueError:
+                raise ValueError("Bad bandwidth schedule window '{0}', expected HH:MM-HH:MM=factor".format(window))
+
+        return windows
+
+    def factor(self, now=None):
+        """ Returns the share of the clients' budgets the schedule allows right now, the first window wins """
+        now = now or datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+
+        for start, end, factor in self.schedule:
+            # A window ending before it starts runs past midnight
+            if start <= minute < end or (end <= start and (minute >= start or minute < end)):
+                return factor
+
+        return 1.0
+
+    def limit(self, budget):
+        """ Returns the client's budget (KB/s) as the schedule has it right now, 0 staying as no limit """
+        if not budget:
+            return 0
+
+        return max(1, int(budget * self.factor()))
+
+    def register(self, client):
+        """ Returns the client's shared counts, set up before the jobs fork so they all count in the same place """
+        if client['id'] not in self.active:
+            self.active[client['id']] = multiprocessing.Array('i', 2)
+
+        return self.active[client['id']]
+
+    @contextlib.contextmanager
+    def lease(self, src_client, dst_client):
+        """ Counts the transfer against both clients while it runs, yields its Lease (None if it isn't capped) """
+        if not self.enabled or not (src_client['max_upload'] or dst_client['max_download']):
+            yield None
+            return
+
+        sides = [(self.register(src_client), self.UPLOADS), (self.register(dst_client), self.DOWNLOADS)]
+        for counts, side in sides:
+            with counts.get_lock():
+                counts[side] += 1
+
+        try:
+            yield Lease(self, [src_client['max_upload'], dst_client['max_download']], sides)
+        finally:
+            for counts, side in sides:
+                with counts.get_lock():
+                    counts[side] -= 1
+
+
+class Lease():
+    """ A running transfer's token bucket """
+
+    def __init__(self, governor, budgets, sides):
+        """ budgets being the KB/s caps of each of the (counts, side) sides, 0 for uncapped """
+        self.governor = governor
+        self.budgets = budgets
+        self.sides = sides
+
+        # Starts out empty, so a run of short transfers can't each go over their share with a full bucket
+        self.tokens = 0
+        self.updated = time.time()
+
+    def rate(self):
+        """ Returns the bytes/s the transfer may use, its share of the tightest of the clients' budgets """
+        return min(self.governor.limit(budget) * 1024 / max(counts[side], 1)
+                   for budget, (counts, side) in zip(self.budgets, self.sides) if budget)
+
+    def consume(self, sent):
+        """ Take the bytes sent out of the bucket, returns the seconds to pause the transfer for (0 for none) """
+        now = time.time()
+        rate = self.rate()
+        capacity = rate * self.governor.burst
+
+        self.tokens = min(capacity, self.tokens + rate * (now - self.updated)) - sent
+        self.updated = now
+
+        if self.tokens >= 0:
+            return 0
+
+        # Longer debts are paid off over several pauses, so the share is picked up again if it grows
+        return min(-self.tokens / rate, self.governor.max_pause)
@@ -0,0 +1,460 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import resource
+import itertools
+import threading
+import subprocess
+import collections
+import configparser
+import multiprocessing
+import http.server
+import urllib.parse
+
+from lib import helper
+from lib.hashing import HashingEngine
+from lib.config import ConfigManager
+from lib.jobqueue import JobQueueManager
+
+
+class FakeFrontend():
+    """
+    Stand-in for the Frontend API, serving the jobs, files and availability endpoints out of memory
+    It runs on a thread of this process, so the calls of forked jobs are counted along with ours
+    """
+
+    ENDPOINT_JOBS = 'jobs'
+    ENDPOINT_FILES = 'files'
+    AVAILABILITY_ENDPOINTS = ('packageavailability', 'fileavailability')
+
+    def __init__(self):
+        """ Setup the (empty) objects and the server, which is started by start() """
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+        # 'METHOD endpoint' -> calls made
+        self.calls = collections.Counter()
+
+        self.jobs = dict()
+        self.files = collections.defaultdict(list)
+        self.availability = {endpoint: dict() for endpoint in self.AVAILABILITY_ENDPOINTS}
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-frontend', daemon=True)
+
+    @property
+    def host(self):
+        """ Returns the base URL the API manager is pointed at """
+        return 'http://{0}:{1}'.format(*self.server.server_address)
+
+    def start(self):
+        """ Serve on a background thread """
+        self.thread.start()
+
+    def stop(self):
+        """ Stop serving """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handler(self):
+        """ Returns the request handler class, answering through this frontend """
+        frontend = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            """ Keep-alive JSON handler, the requests go to FakeFrontend.dispatch """
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def respond(self, method):
+                url = urllib.parse.urlsplit(self.path)
+                parts = [part for part in url.path.split('/') if part]
+                params = dict(urllib.parse.parse_qsl(url.query))
+
+                length = int(self.headers.get('Content-Length') or 0)
+                data = json.loads(self.rfile.read(length).decode('utf-8')) if length else None
+
+                status, body = frontend.dispatch(method, parts, params, data)
+                payload = json.dumps(body).encode('utf-8')
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self.respond('GET')
+
+            def do_POST(self):
+                self.respond('POST')
+
+            def do_PATCH(self):
+                self.respond('PATCH')
+
+        return Handler
+
+    def dispatch(self, method, parts, params, data):
+        """ Returns the (status, body) of the request """
+        endpoint = parts[0] if parts else ''
+
+        with self.lock:
+            self.calls['{0} {1}'.format(method, endpoint)] += 1
+
+            if endpoint == self.ENDPOINT_JOBS:
+                return self.jobs_endpoint(method, parts[1:], params, data)
+            if endpoint == self.ENDPOINT_FILES and method == 'GET':
+                return self.files_endpoint(params)
+            if endpoint in self.availability:
+                return self.availability_endpoint(self.availability[endpoint], method, parts[1:], params, data)
+
+        return 404, {'detail': 'Not found.'}
+
+    def jobs_endpoint(self, method, parts, params, data):
+        """ Lists the jobs (by state), a PATCH updating one's state or progress """
+        if method == 'GET' and not parts:
+            return 200, [job for job in self.jobs.values() if job['state'] == params.get('state', job['state'])]
+
+        if method == 'PATCH' and parts and int(parts[0]) in self.jobs:
+            self.jobs[int(parts[0])].update(data)
+            return 200, self.jobs[int(parts[0])]
+
+        return 404, {'detail': 'Not found.'}
+
+    def files_endpoint(self, params):
+        """ The files of a package, paged when a limit is given """
+        files = self.files[int(params['package__in'])]
+        if 'limit' not in params:
+            return 200, files
+
+        limit, offset = int(params['limit']), int(params.get('offset', 0))
+        more = offset + limit < len(files)
+
+        return 200, {'count': len(files), 'next': 'more' if more else None, 'previous': None,
+                     'results': files[offset:offset + limit]}
+
+    @staticmethod
+    def matches(instance, params):
+        """ Does the availability object pass the filters, 'field__in' being a comma separated list """
+        for key, value in params.items():
+            if key.endswith('__in'):
+                if str(instance[key[:-len('__in')]]) not in value.split(','):
+                    return False
+            elif str(instance.get(key)) != value:
+                return False
+
+        return True
+
+    def availability_endpoint(self, objects, method, parts, params, data):
+        """ Filtered lists, single and bulk creates and single and bulk updates of availability objects """
+        if method == 'GET':
+            return 200, [instance for instance in objects.values() if self.matches(instance, params)]
+
+        if method == 'POST':
+            created = list()
+            for instance in (data if isinstance(data, list) else [data]):
+                instance = dict(instance, id=next(self.ids))
+                objects[instance['id']] = instance
+                created.append(instance)
+
+            return 201, created if isinstance(data, list) else created[0]
+
+        if method == 'PATCH':
+            updates = [dict(data, id=int(parts[0]))] if parts else data
+            if any(update['id'] not in objects for update in updates):
+                return 400, {'detail': 'Unknown object.'}
+
+            for update in updates:
+                objects[update['id']]['availability'] = update['availability']
+
+            return 200, objects[updates[0]['id']] if parts else [objects[update['id']] for update in updates]
+
+        return 405, {'detail': 'Method not allowed.'}
+
+
+class Instruments():
+    """
+    Counts the subprocesses spawned and the bytes hashed while installed
+    The counts are kept in shared memory so the forked jobs add to them as well
+    """
+
+    def __init__(self):
+        """ Setup the shared counters """
+        self.spawned = multiprocessing.Value('q', 0)
+        self.hashed = multiprocessing.Value('q', 0)
+
+        self.originals = None
+
+    @staticmethod
+    def add(counter, amount):
+        """ Add to the shared counter """
+        with counter.get_lock():
+            counter.value += amount
+
+    def counts(self):
+        """ Returns the (spawned, hashed) counts so far """
+        return self.spawned.value, self.hashed.value
+
+    def install(self):
+        """ Wrap subprocess.Popen (which asyncio spawns through as well) and the file hashing """
+        instruments = self
+        popen = subprocess.Popen
+        hash_file = helper.hash_file
+        engine_hash_file = HashingEngine.__dict__['hash_file']
+
+        class CountingPopen(popen):
+            def __init__(self, *args, **kwargs):
+                instruments.add(instruments.spawned, 1)
+                popen.__init__(self, *args, **kwargs)
+
+        def counting_hash_file(path):
+            instruments.add(instruments.hashed, os.stat(path).st_size)
+            return hash_file(path)
+
+        def counting_engine_hash_file(cls, path):
+            # Smaller files are handed to helper.hash_file, which counts them
+            size = os.stat(path).st_size
+            if size >= cls.MMAP_THRESHOLD:
+                instruments.add(instruments.hashed, size)
+            return engine_hash_file.__func__(cls, path)
+
+        self.originals = (popen, hash_file, engine_hash_file)
+        subprocess.Popen = CountingPopen
+        helper.hash_file = counting_hash_file
+        HashingEngine.hash_file = classmethod(counting_engine_hash_file)
+
+    def uninstall(self):
+        """ Put the originals back """
+        if self.originals:
+            subprocess.Popen, helper.hash_file, HashingEngine.hash_file = self.originals
+            self.originals = None
+
+
+class Benchmark():
+    """
+    Runs SYNC/INDEX/DEL jobs end to end through the JobQueueManager's run loop against a FakeFrontend,
+    between two local clients (directories under root) holding a synthetic package
+    """
+
+    ACTIONS = ('SYNC', 'INDEX', 'DEL')
+
+    PACKAGE_ID = 1
+    PACKAGE_NAME = 'benchmark'
+    # Files per directory of the synthetic package
+    DIRECTORY_SIZE = 1000
+    # Seconds a job gets before the run is given up on
+    TIMEOUT = 600
+
+    def __init__(self, root, file_count, file_size, config_file=None, engine=None, transfer_mode=None,
+                 timeout=None):
+        """
+        Setup the frontend, the instruments and the clients' directories
+        Everything goes in root, which has to be empty (or not exist yet) as all of it is removed afterwards,
+        without a root a temporary directory is used
+        """
+        if root and os.path.isdir(root) and os.listdir(root):
+            raise Exception('Benchmark directory {0} is not empty, give an empty or new one'.format(root))
+
+        # Only a directory of our own making is removed itself, a given one is only emptied out
+        self.temporary = not root
+        self.root = os.path.abspath(root or tempfile.mkdtemp(prefix='jqm-benchmark-'))
+        self.file_count = file_count
+        self.file_size = file_size
+        self.config_file = config_file
+        self.engine = engine
+        self.transfer_mode = transfer_mode
+        self.timeout = timeout or self.TIMEOUT
+
+        self.frontend = FakeFrontend()
+        self.instruments = Instruments()
+        self.job_ids = itertools.count(1)
+
+        self.clients = {
+            'source': self.client(1, 'benchmark-source', os.path.join(self.root, 'source', '')),
+            'destination': self.client(2, 'benchmark-destination', os.path.join(self.root, 'destination', '')),
+        }
+
+    @staticmethod
+    def client(client_id, name, base_path):
+        """ Returns a local client (the API blanks out the host details of the client we run on) """
+        return {'id': client_id, 'name': name, 'base_path': base_path, 'host_hostname': '', 'host_port': 0,
+                'host_username': '', 'max_upload': 0, 'max_download': 0}
+
+    def setup(self):
+        """ Write out the package on the source client, register it with the frontend and start it """
+        os.makedirs(self.root, exist_ok=True)
+        block = os.urandom(self.file_size)
+        files = self.frontend.files[self.PACKAGE_ID]
+
+        for i in range(self.file_count):
+            relative_path = '{0}/{1:04d}/file_{2}.bin'.format(self.PACKAGE_NAME, i // self.DIRECTORY_SIZE, i)
+            path = self.clients['source']['base_path'] + relative_path
+
+            # Every file is the same random block behind its own index, so no two hash the same
+            data = i.to_bytes(8, 'big') + block[8:] if self.file_size >= 8 else block
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+
+            files.append({'id': i + 1, 'package': self.PACKAGE_ID, 'relative_path': relative_path,
+                          'file_hash': hashlib.sha256(data).hexdigest(), 'file_size': len(data)})
+
+        self.frontend.start()
+
+    def teardown(self):
+        """ Stop the frontend and remove the clients' directories and the daemon's files """
+        self.frontend.stop()
+
+        if self.temporary:
+            shutil.rmtree(self.root, ignore_errors=True)
+            return
+
+        # The root was empty when we were given it, so all it holds now is ours
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+    def prepare(self, action):
+        """ A SYNC starts off an empty destination, INDEX and DEL off a full copy of the package """
+        destination = self.clients['destination']['base_path'] + self.PACKAGE_NAME
+        shutil.rmtree(destination, ignore_errors=True)
+
+        if action != 'SYNC':
+            shutil.copytree(self.clients['source']['base_path'] + self.PACKAGE_NAME, destination)
+
+    def config(self):
+        """ Returns the config of a JobQueueManager pointed at the frontend (and polling it constantly) """
+        config_parser = configparser.ConfigParser()
+        if self.config_file:
+            config_parser.read(self.config_file)
+
+        for section in (ConfigManager.DAEMON, ConfigManager.API, ConfigManager.SYNC):
+            if not config_parser.has_section(section):
+                config_parser.add_section(section)
+
+        config_parser[ConfigManager.DAEMON].update({
+            'pid_file': os.path.join(self.root, 'benchmark.pid'), 'log_name': 'benchmark', 'log_dir': self.root,
+            'working_dir': self.root, 'umask': '0', 'sleep': '0.05', 'min_sleep': '0.05', 'intake': 'poll'})
+        config_parser[ConfigManager.API].update({'host': self.frontend.host, 'token': 'benchmark'})
+
+        if self.engine:
+            config_parser[ConfigManager.SYNC]['engine'] = self.engine
+        if self.transfer_mode:
+            config_parser[ConfigManager.SYNC]['transfer_mode'] = self.transfer_mode
+
+        config_file = os.path.join(self.root, 'benchmark.conf')
+        with open(config_file, 'w') as f:
+            config_parser.write(f)
+
+        return ConfigManager(config_file).get_config()
+
+    def run(self, action):
+        """ Run a single job of the action through the run loop, returns its measurements """
+        self.prepare(action)
+
+        job_id = next(self.job_ids)
+        self.frontend.jobs[job_id] = {
+            'id': job_id, 'action': action, 'state': 'PEND', 'priority': 0,
+            'package': {'id': self.PACKAGE_ID, 'name': self.PACKAGE_NAME},
+            'source_client': self.clients['source'], 'destination_client': self.clients['destination']}
+
+        manager = JobQueueManager(config=self.config(), verbose=0, daemon=False)
+
+        calls = collections.Counter(self.frontend.calls)
+        spawned, hashed = self.instruments.counts()
+
+        # Whether the job was seen running and whether it ran out of time, as set by watch()
+        seen = threading.Event()
+        timed_out = threading.Event()
+
+        def watch():
+            """
+            Stop the run loop once the job is over and reaped, once its process is gone (even without reporting
+            back) or once it has run out of time, killing it off
+            """
+            deadline = time.time() + self.timeout
+
+            while manager.running:
+                process = manager.sync_manager.processing_job_ids.get(job_id)
+                if process is not None:
+                    seen.set()
+
+                if self.frontend.jobs[job_id]['state'] in ('COMP', 'FAIL') \
+                        and not manager.sync_manager.processing_queue:
+                    manager.running = False
+                elif seen.is_set() and process is None:
+                    manager.running = False
+                elif time.time() > deadline:
+                    timed_out.set()
+                    if process is not None:
+                        process.terminate()
+                        process.join(5)
+                    manager.running = False
+                time.sleep(0.01)
+
+        watcher = threading.Thread(target=watch, daemon=True)
+        self.instruments.install()
+        started = time.time()
+
+        try:
+            watcher.start()
+            manager.run()
+        finally:
+            wall = time.time() - started
+            self.instruments.uninstall()
+            manager.running = False
+            watcher.join()
+            self.close(manager)
+
+        # A job that ran out of time or went away without reporting back counts as failed
+        state = self.frontend.jobs[job_id]['state']
+        if timed_out.is_set() or state not in ('COMP', 'FAIL'):
+            state = 'FAIL'
+
+        api_calls = self.frontend.calls - calls
+        return {
+            'action': action,
+            'state': state,
+            'timed_out': timed_out.is_set(),
+            'files': self.file_count,
+            'bytes': self.file_count * self.file_size,
+            'wall': wall,
+            'api_calls': sum(api_calls.values()),
+            'api_calls_by_endpoint': dict(api_calls),
+            'spawned': self.instruments.spawned.value - spawned,
+            'hashed': self.instruments.hashed.value - hashed,
+            # ru_maxrss is in KB on Linux, the children being the forked jobs and the commands they ran
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'peak_child_rss': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        }
+
+    @staticmethod
+    def close(manager):
+        """ Let go of everything the manager holds on to, including its log file """
+        manager.sync_manager.engine.stop()
+        manager.intake.close()
+        manager.ssh_pool.close_all()
+        manager.api_manager.close()
+
+        manager.log.stop()
+        for handler in list(manager.logger.handlers):
+            manager.logger.removeHandler(handler)
+            handler.close()
+        manager.log.handler.close()
+
+    def run_all(self, actions=ACTIONS, repeat=1):
+        """ Run the actions (repeat times each), returns the list() of measurements """
+        self.setup()
+
+        try:
+            return [self.run(action) for _ in range(repeat) for action in actions]
+        finally:
+            self.teardown()
@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import collections
+
+from lib import helper
+
+
+class LruCache():
+    """
+    Size bounded key -> value store that evicts the least recently used entries
+    Optionally backed by a SQLite database so it survives daemon restarts and is shared between the job
+    processes: what we don't hold is looked up in it, and save() writes just what changed since the last save
+    Keys and values are (tuples of) plain JSON types
+    """
+
+    SCHEMA = 'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, used REAL NOT NULL)'
+    INDEX = 'CREATE INDEX IF NOT EXISTS entries_used ON entries (used)'
+
+    def __init__(self, max_size, path=None):
+        """ Setup the cache, the database is opened on first use """
+        self.max_size = max_size
+        self.path = path
+        self.entries = collections.OrderedDict()
+
+        # Changes not saved yet, key -> value (None once invalidated)
+        self.changed = dict()
+
+        self.hits = 0
+        self.misses = 0
+
+        self._connection = None
+        self._connection_pid = None
+
+        # Transfers within a job run on threads that share the cache
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    @property
+    def connection(self):
+        """
+        Returns the database connection of this process
+        A forked job must not share the parent's connection, so it opens its own on first use
+        """
+        if self._connection is None or self._connection_pid != os.getpid():
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(self.SCHEMA)
+            self._connection.execute(self.INDEX)
+            self._connection.commit()
+            self._connection_pid = os.getpid()
+
+        return self._connection
+
+    @staticmethod
+    def encode(value):
+        return json.dumps(value)
+
+    @staticmethod
+    def decode(data):
+        value = json.loads(data)
+        return tuple(value) if isinstance(value, list) else value
+
+    def get(self, key, default=None):
+        """ Returns the cached value (marking it as recently used) or the default """
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                value = self.fetch(key)
+                if value is None:
+                    self.misses += 1
+                    return default
+
+                self.entries[key] = value
+                self.evict()
+
+            self.hits += 1
+            return self.entries[key]
+
+    def fetch(self, key):
+        """ Returns the value waiting to be saved or saved in the database, None if there isn't one """
+        if key in self.changed:
+            return self.changed[key]
+
+        if not self.path:
+            return None
+
+        row = self.connection.execute('SELECT value FROM entries WHERE key = ?', (self.encode(key),)).fetchone()
+        return self.decode(row[0]) if row else None
+
+    def set(self, key, value):
+        """ Cache the value, evicting the least recently used entries if we are full """
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if self.path:
+                self.changed[key] = value
+            self.evict()
+
+    def pop(self, key):
+        """ Invalidate the cached value """
+        with self.lock:
+            if self.path:
+                self.changed[key] = None
+            return self.entries.pop(key, None)
+
+    def evict(self):
+        """ Drop the least recently used entries until we fit, what's waiting to be saved is kept until then """
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        """ Returns the hit/miss counts and size of the cache """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+    def save(self):
+        """
+        Write what changed since the last save to the database, in one transaction
+        Past max_size the entries saved the longest ago are dropped
+        """
+        if not self.path or not self.changed:
+            return
+
+        with self.lock:
+            changed, self.changed = self.changed, dict()
+            now = time.time()
+
+            with self.connection as connection:
+                connection.executemany('DELETE FROM entries WHERE key = ?',
+                                       [(self.encode(key),) for key, value in changed.items() if value is None])
+                connection.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                                       [(self.encode(key), self.encode(value), now)
+                                        for key, value in changed.items() if value is not None])
+
+                excess = connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0] - self.max_size
+                if excess > 0:
+                    connection.execute('DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY used '
+                                       'LIMIT ?)', (excess,))
+
+
+class HashCache(LruCache):
+    """
+    Remembers the hash of files along with the stat metadata (size, mtime_ns, inode, device) they had when hashed
+    A hash is only trusted while the file's stat metadata still matches, so a changed file is always rehashed
+    Keyed on (client host, port, username, path), a blank host being the box we are running on
+    """
+    STAT_FIELDS = helper.STAT_FIELDS
+
+    @staticmethod
+    def client_key(client, path):
+        """ Returns the key the given client's file is cached under """
+        return client['host_hostname'], client['host_port'], client['host_username'], path
+
+    def known(self, client, path):
+        """ Returns the cached stat + hash of the file as the helper expects it, or None """
+        entry = self.get(self.client_key(client, path))
+        if entry is None:
+            return None
+
+        known = dict(zip(self.STAT_FIELDS, entry[:-1]))
+        known['hash'] = entry[-1]
+        return known
+
+    def store(self, client, path, stat, digest):
+        """ Cache the hash of the file along with the stat metadata it was hashed with """
+        self.set(self.client_key(client, path), tuple(stat[field] for field in self.STAT_FIELDS) + (digest,))
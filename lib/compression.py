@@ -0,0 +1,153 @@
+import os
+import zlib
+import time
+import collections
+
+from lib.config import ConfigManager
+
+
+class CompressionPolicy():
+    """
+    Decides whether rsync should compress a transfer, and with what algorithm and level
+    Looks at the file extensions, a compressibility probe of the source files and how fast the link is
+    """
+
+    MODE_AUTO = 'auto'
+    MODE_ALWAYS = 'always'
+    MODE_NEVER = 'never'
+    MODES = (MODE_AUTO, MODE_ALWAYS, MODE_NEVER)
+
+    LINK_UNLIMITED = 'unlimited'
+    LINK_FAST = 'fast'
+    LINK_SLOW = 'slow'
+
+    # Already compressed formats, compressing them again only burns CPU
+    INCOMPRESSIBLE_EXTENSIONS = frozenset([
+        '7z', 'bz2', 'gz', 'lz4', 'lzma', 'rar', 'tbz2', 'tgz', 'txz', 'xz', 'z', 'zip', 'zst',
+        'aac', 'avi', 'flac', 'gif', 'jpeg', 'jpg', 'm4a', 'm4v', 'mkv', 'mov', 'mp3', 'mp4', 'ogg', 'png',
+        'webm', 'webp', 'wmv',
+    ])
+
+    # How much of a file the probe compresses, and how many files it looks at
+    PROBE_SIZE = 64 * 1024
+    PROBE_FILES = 5
+    # Below this many sampled bytes the zlib overhead swamps the ratio, so the probe has no opinion
+    PROBE_MINIMUM = 4096
+    # Compressed/original size above which the probe calls the data incompressible
+    PROBE_RATIO = 0.9
+
+    Decision = collections.namedtuple('Decision', ['compress', 'choice', 'level', 'link', 'reason'])
+
+    def __init__(self, compression_config=None, logger=None):
+        """ Setup the policy thresholds """
+        if compression_config is None:
+            compression_config = ConfigManager.default_section(ConfigManager.COMPRESSION)
+
+        if compression_config.mode not in self.MODES:
+            raise Exception('Unknown compression mode \'{0}\', expected one of: {1}'.format(compression_config.mode,
+                                                                                       ', '.join(self.MODES)))
+
+        self.logger = logger
+        self.mode = compression_config.mode
+        self.choice = compression_config.choice
+        self.fast_link = int(compression_config.fast_link)
+        self.fast_level = int(compression_config.fast_level)
+        self.slow_level = int(compression_config.slow_level)
+
+        # The most recent (decision, bytes, seconds, bytes/s) of the transfers we made
+        self.history = collections.deque(maxlen=1000)
+
+    @staticmethod
+    def bandwidth(src_client, dst_client):
+        """ Returns the KB/s the transfer is capped at (the smaller of upload/download), 0 for no cap """
+        limits = [limit for limit in (src_client['max_upload'], dst_client['max_download']) if limit]
+        return min(limits) if limits else 0
+
+    def link_class(self, src_client, dst_client):
+        """ An uncapped client is taken to be on the LAN """
+        bandwidth = self.bandwidth(src_client, dst_client)
+
+        if not bandwidth:
+            return self.LINK_UNLIMITED
+        elif bandwidth >= self.fast_link:
+            return self.LINK_FAST
+        else:
+            return self.LINK_SLOW
+
+    @classmethod
+    def incompressible(cls, relative_path):
+        """ Going by the extension, is the file already compressed """
+        return os.path.splitext(relative_path)[1].lstrip('.').lower() in cls.INCOMPRESSIBLE_EXTENSIONS
+
+    def probe(self, paths):
+        """
+        Compress a sample from the start of up to PROBE_FILES of the files
+        Returns the compressed/original ratio, or None if there wasn't enough to go on
+        """
+        original = 0
+        compressed = 0
+
+        for path in paths[:self.PROBE_FILES]:
+            try:
+                with open(path, 'rb') as f:
+                    sample = f.read(self.PROBE_SIZE)
+            except OSError:
+                continue
+
+            original += len(sample)
+            compressed += len(zlib.compress(sample, 1))
+
+        if original < self.PROBE_MINIMUM:
+            return None
+
+        return compressed / original
+
+    def decide(self, src_client, dst_client, package_files):
+        """ Returns the compression Decision for sending the files from src_client to dst_client """
+        link = self.link_class(src_client, dst_client)
+
+        if self.mode == self.MODE_NEVER:
+            return self.Decision(False, None, None, link, 'compression disabled')
+        if self.mode == self.MODE_ALWAYS:
+            return self.Decision(True, self.choice, self.slow_level, link, 'compression forced')
+
+        if link == self.LINK_UNLIMITED:
+            return self.Decision(False, None, None, link, 'uncapped (LAN) link')
+
+        compressible = [package_file for package_file in package_files
+                        if not self.incompressible(package_file['relative_path'])]
+        if not compressible:
+            return self.Decision(False, None, None, link, 'already compressed file types')
+
+        # We can only look inside the files when they are on this box
+        if not src_client['host_hostname']:
+            ratio = self.probe([src_client['base_path'] + package_file['relative_path']
+                                for package_file in compressible])
+            if ratio is not None and ratio > self.PROBE_RATIO:
+                return self.Decision(False, None, None, link, 'probe ratio {0:.2f}'.format(ratio))
+
+        # Cheap compression keeps up with a fast link, a slow link is worth spending CPU on
+        level = self.fast_level if link == self.LINK_FAST else self.slow_level
+        return self.Decision(True, self.choice, level, link, '{0} link'.format(link))
+
+    @staticmethod
+    def rsync_options(decision):
+        """ Returns the rsync options that apply the decision """
+        if not decision.compress:
+            return list()
+
+        options = ['--compress', '--compress-level={0}'.format(decision.level)]
+        if decision.choice:
+            options.append('--compress-choice={0}'.format(decision.choice))
+
+        return options
+
+    def record(self, decision, size, started):
+        """ Record the throughput we achieved with the decision, for tuning the thresholds """
+        elapsed = max(time.time() - started, 0.001)
+        self.history.append((decision, size, elapsed, size / elapsed))
+
+        if self.logger:
+            self.logger.info('compress={0} choice={1} level={2} link={3} reason="{4}" bytes={5} seconds={6:.2f} '
+                             'rate={7:.0f}B/s'.format(decision.compress, decision.choice, decision.level,
+                                                      decision.link, decision.reason, size, elapsed, size / elapsed))
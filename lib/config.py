@@ -9,12 +9,41 @@ class ConfigManager():
 
     DAEMON = 'DAEMON'
     API = 'API'
+    SYNC = 'SYNC'
+    SSH = 'SSH'
+    COMPRESSION = 'COMPRESSION'
+    SLOTS = 'SLOTS'
+    SCHEDULER = 'SCHEDULER'
+    HASHING = 'HASHING'
+    BANDWIDTH = 'BANDWIDTH'
+    METRICS = 'METRICS'
 
     default_config = {
         DAEMON: ['pid_file', 'log_name', 'log_dir', 'working_dir', 'umask', 'sleep']
         , API: ['host', 'token']
     }
 
+    # Options that may be left out of the config file, along with the value they default to
+    optional_config = {
+        DAEMON: {'intake': 'poll', 'min_sleep': '5', 'long_poll_wait': '60', 'push_endpoint': 'jobs/events',
+                 'log_level': 'DEBUG', 'log_format': 'text', 'log_rotate': '', 'log_max_bytes': '10485760',
+                 'log_backups': '5', 'log_when': 'midnight'}
+        , SYNC: {'batch_verify': 'yes', 'manifest_sync': 'yes', 'hash_cache_size': '500000',
+                 'hash_cache_file': 'hash_cache.db', 'transfer_mode': 'package', 'transfer_concurrency': '4',
+                 'max_streams_per_client': '4', 'engine': 'process', 'checkpoint_file': '',
+                 'partial_dir': '.rsync-partial', 'chunk_size': '5000', 'progress_interval': '10'}
+        , SSH: {'connection_pool': 'yes', 'idle_timeout': '300', 'control_dir': 'jqm-ssh'}
+        , API: {'pool_size': '10', 'page_size': '1000', 'connect_timeout': '5', 'read_timeout': '60', 'retries': '3',
+                'backoff_factor': '0.5', 'availability_cache_size': '100000',
+                'availability_cache_file': 'availability_cache.db'}
+        , COMPRESSION: {'mode': 'auto', 'choice': '', 'fast_link': '10000', 'fast_level': '1', 'slow_level': '6'}
+        , SLOTS: {'max_jobs': '8', 'max_sync': '4', 'max_del': '2', 'max_index': '2', 'max_per_client': '2'}
+        , SCHEDULER: {'aging': '600', 'lan_rate': '100000'}
+        , HASHING: {'workers': '0', 'per_device': '2'}
+        , BANDWIDTH: {'governor': 'yes', 'burst': '1', 'max_pause': '5', 'schedule': ''}
+        , METRICS: {'port': '', 'address': '127.0.0.1', 'flush_interval': '5'}
+    }
+
     class Config():
         """
         Holds all the configuration sections
@@ -29,6 +58,31 @@ class ConfigManager():
         def __init__(self):
             pass
 
+    @staticmethod
+    def as_bool(value):
+        """
+        Convert a config value ('yes', 'no', 'true', 'off', etc) into a bool
+        """
+        if isinstance(value, bool):
+            return value
+
+        try:
+            return configparser.ConfigParser.BOOLEAN_STATES[str(value).lower()]
+        except KeyError:
+            raise ValueError('Not a boolean config value: {0}'.format(value))
+
+    @classmethod
+    def default_section(cls, section):
+        """
+        Build a Section holding just the defaults of an optional section
+        """
+        default_section = ConfigManager.Section()
+
+        for option, value in cls.optional_config[section].items():
+            setattr(default_section, option, value)
+
+        return default_section
+
     @staticmethod
     def bail_with(message):
         """
@@ -48,7 +102,7 @@ class ConfigManager():
 
         try:
             with open(config_file, 'r') as f:
-                config_parser.read(f)
+                config_parser.read_file(f)
         except IOError:
             message = "ERROR: Something is wrong with the config file: {0}".format(config_file)
             self.bail_with(message)
@@ -69,6 +123,19 @@ class ConfigManager():
                                 , option
                                 , config_parser[section][option])
 
+        # Fill in the optional options, anything not given in the config file gets its default
+        for section in self.optional_config:
+            if not hasattr(self.config, section):
+                setattr(self.config, section, ConfigManager.Section())
+
+            for option, default in self.optional_config[section].items():
+                if section in config_parser.sections() and option in config_parser.options(section):
+                    value = config_parser[section][option]
+                else:
+                    value = default
+
+                setattr(getattr(self.config, section), option, value)
+
     def get_config(self):
         """
         Return ConfigParser() object
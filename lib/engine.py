@@ -0,0 +1,355 @@
+import json
+import time
+import codecs
+import signal
+import asyncio
+import functools
+import threading
+import contextvars
+import subprocess
+import multiprocessing
+import concurrent.futures
+
+from lib import metrics
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class ProcessEngine():
+    """
+    Runs every job in a forked process of its own
+    The job's commands and job updates are made straight from its process, blocking it while they run
+    """
+
+    def __init__(self, sync_manager):
+        """ Jobs run the sync manager's handle_package """
+        self.sync_manager = sync_manager
+
+    def start(self, job):
+        """ Fork off a process for the job, returns the started process """
+        function_args = (job['id'], job['package'], job['source_client'], job['destination_client'], job['action'])
+        p = multiprocessing.Process(target=self.run, args=function_args, name=job['name'])
+        p.start()
+
+        return p
+
+    def run(self, *args):
+        """ Runs in the forked process, sending the job's metrics on to the parent once it's done """
+        try:
+            self.sync_manager.handle_package(*args)
+        finally:
+            metrics.registry.flush()
+
+    def stop(self):
+        """ The processes are terminated by whoever holds onto them """
+        pass
+
+    # What the sync manager runs its commands and job updates through
+    def shell_out(self, command):
+        return self.sync_manager.shell_out(command)
+
+    def stream_out(self, command, lines):
+        return self.sync_manager.stream_out(command, lines)
+
+    def parse_out(self, command, parser, lease=None):
+        return self.sync_manager.parse_out(command, parser, lease)
+
+    def update_job_state(self, job_id, state):
+        return self.sync_manager.api_manager.update_job_state(job_id, state)
+
+    def update_job_progress(self, job_id, progress):
+        return self.sync_manager.api_manager.update_job_progress(job_id, progress)
+
+
+class AsyncioJob():
+    """ Handle on a job running on a thread of the engine, looks like a multiprocessing.Process """
+
+    def __init__(self, name):
+        """ future is resolved once the job is over """
+        self.name = name
+        self.future = concurrent.futures.Future()
+
+        # The engine calls the job is waiting on, cancelled if the job is terminated
+        self.waiting = set()
+        self.terminated = False
+        self.lock = threading.Lock()
+
+    def is_alive(self):
+        return not self.future.done()
+
+    def join(self, timeout=None):
+        concurrent.futures.wait([self.future], timeout=timeout)
+
+    def terminate(self):
+        """ Cancel what the job is waiting on, the job then stops at its next command """
+        with self.lock:
+            self.terminated = True
+            for future in self.waiting:
+                future.cancel()
+
+
+class AsyncioEngine():
+    """
+    Runs every job on a thread of the daemon, the job's commands and job updates being run by one asyncio
+    event loop (in a background thread) while the job's thread waits on them
+    The jobs mostly wait on ssh, rsync and the API, so the loop multiplexes the pipes of every job's commands
+    (and their job updates over aiohttp, when it is installed) instead of a process per job doing its own
+    """
+
+    class JobTerminated(Exception):
+        """ The job was terminated (or the engine stopped) while it was running """
+        pass
+
+    def __init__(self, sync_manager):
+        """ The loop is started with the first job, after the daemon has forked itself """
+        self.sync_manager = sync_manager
+        self.logger = sync_manager.logger
+
+        self.loop = None
+        self.thread = None
+        self.http_session = None
+        self.stopped = False
+        self.lock = threading.Lock()
+
+        # The AsyncioJob of whatever is calling us, the job's transfer threads carry it on from the job's thread
+        self.current_job = contextvars.ContextVar('current_job', default=None)
+
+    def start(self, job):
+        """ Start the job on a thread, returns a process-like handle on it """
+        with self.lock:
+            if self.stopped:
+                raise self.JobTerminated('The engine has been stopped')
+
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, name='asyncio-engine', daemon=True)
+                self.thread.start()
+
+        handle = AsyncioJob(job['name'])
+        function_args = (handle, job['id'], job['package'], job['source_client'], job['destination_client'],
+                         job['action'])
+        threading.Thread(target=self.run, args=function_args, name=job['name'], daemon=True).start()
+
+        return handle
+
+    def run(self, handle, *args):
+        """ Runs on the job's thread """
+        self.current_job.set(handle)
+        handle.future.set_running_or_notify_cancel()
+
+        try:
+            handle.future.set_result(self.sync_manager.handle_package(*args))
+        except Exception as e:
+            if isinstance(e, self.JobTerminated):
+                self.logger.warning('Job {0} was terminated'.format(handle.name))
+            else:
+                self.logger.error('Job {0} failed with an unexpected error ({1})'.format(handle.name, e))
+            handle.future.set_exception(e)
+
+    def stop(self):
+        """ Cancel everything the jobs are waiting on, close the HTTP session and stop the loop """
+        with self.lock:
+            self.stopped = True
+
+        if self.loop is None:
+            return
+
+        try:
+            asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result(timeout=10)
+        except concurrent.futures.TimeoutError:
+            self.logger.warning('The asyncio engine took too long to wind down, stopping it regardless')
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+        if not self.thread.is_alive():
+            self.loop.close()
+
+    async def shutdown(self):
+        """ Cancel the outstanding tasks and wait for them to wind down (killing their commands) """
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self.http_session is not None:
+            await self.http_session.close()
+
+    def call(self, function, *args):
+        """ Run the coroutine function on the loop, the calling (job's) thread waiting on its result """
+        job = self.current_job.get()
+
+        with self.lock:
+            if self.stopped or (job is not None and job.terminated):
+                raise self.JobTerminated('The job has been terminated')
+            future = asyncio.run_coroutine_threadsafe(function(*args), self.loop)
+
+        if job is not None:
+            with job.lock:
+                job.waiting.add(future)
+                if job.terminated:
+                    future.cancel()
+
+        try:
+            return future.result()
+        except concurrent.futures.CancelledError:
+            raise self.JobTerminated('The job has been terminated')
+        finally:
+            if job is not None:
+                with job.lock:
+                    job.waiting.discard(future)
+
+    # What the sync manager runs its commands and job updates through
+    def shell_out(self, command):
+        """ Run the command, returns its output, raising CalledProcessError if it fails """
+        returncode, stdout, stderr = self.call(self.execute, command)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, command, output=stdout, stderr=stderr)
+
+        return stdout
+
+    def stream_out(self, command, lines):
+        """
+        Run the command feeding it the lines, yields each line of its output
+        The output is gathered on the loop as it arrives and only handed back once the command is done
+        """
+        returncode, stdout, stderr = self.call(self.execute, command, ''.join(line + '\n' for line in lines))
+
+        for line in stdout.splitlines(True):
+            yield line
+
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, command, stderr=stderr)
+
+    def parse_out(self, command, parser, lease=None):
+        """ Run the command feeding its output to the parser, returns (returncode, the parser's output, stderr) """
+        return self.call(self.execute, command, None, parser, lease)
+
+    def update_job_state(self, job_id, state):
+        """ PATCH the job's state, over aiohttp if we have it """
+        if aiohttp is None:
+            return self.sync_manager.api_manager.update_job_state(job_id, state)
+
+        return self.call(self.patch_job, job_id, {'state': state})
+
+    def update_job_progress(self, job_id, progress):
+        """ PATCH the job's progress from the loop, the job carries on without waiting for it """
+        if self.stopped:
+            return
+
+        def sent(future):
+            if not future.cancelled() and future.exception() is not None:
+                self.logger.warning('Unable to report the progress of job {0} ({1})'.format(job_id,
+                                                                                          future.exception()))
+
+        if aiohttp is None:
+            function = functools.partial(self.sync_manager.api_manager.update_job_progress, job_id, progress)
+            self.loop.call_soon_threadsafe(lambda: self.loop.run_in_executor(None, function).add_done_callback(sent))
+        else:
+            asyncio.run_coroutine_threadsafe(self.patch_job(job_id, progress), self.loop).add_done_callback(sent)
+
+    # Run on the loop
+    async def execute(self, command, data=None, parser=None, lease=None):
+        """
+        Run the command, feeding it data on stdin
+        Given a parser, stdout is fed to it as it arrives and the output it kept is returned as stdout
+        (pausing the command whenever it sends more than the share of the bandwidth Lease given)
+        A cancelled command is killed
+        Returns (returncode, stdout, stderr)
+        """
+        stdin = asyncio.subprocess.PIPE if data is not None else asyncio.subprocess.DEVNULL
+        process = await asyncio.create_subprocess_exec(*command, stdin=stdin, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE)
+
+        async def parse_stdout():
+            """ Feed the parser while stderr is read alongside, so neither pipe fills up """
+            decoder = codecs.getincrementaldecoder('utf-8')('replace')
+            while True:
+                chunk = await process.stdout.read(65536)
+                if not chunk:
+                    break
+                parser.feed(decoder.decode(chunk))
+
+                pause = lease.consume(parser.take()) if lease else 0
+                if pause:
+                    await self.pause(process, pause)
+            parser.feed(decoder.decode(b'', final=True))
+
+        try:
+            if parser is None:
+                stdout, stderr = await process.communicate(data.encode('utf-8') if data is not None else None)
+                return process.returncode, stdout.decode('utf-8', 'replace'), stderr.decode('utf-8', 'replace')
+
+            _, stderr = await asyncio.gather(parse_stdout(), process.stderr.read())
+            await process.wait()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+
+        return process.returncode, parser.close(), stderr.decode('utf-8', 'replace')
+
+    @staticmethod
+    async def pause(process, seconds):
+        """ Stop the process for the seconds given, unless it's already gone """
+        try:
+            process.send_signal(signal.SIGSTOP)
+        except ProcessLookupError:
+            return
+
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            try:
+                process.send_signal(signal.SIGCONT)
+            except ProcessLookupError:
+                pass
+
+    async def patch_job(self, job_id, data):
+        """ PATCH the job over aiohttp, retrying connection errors and server hiccups as the API manager does """
+        api_manager = self.sync_manager.api_manager
+
+        if self.http_session is None:
+            connect_timeout, read_timeout = api_manager.timeout
+            self.http_session = aiohttp.ClientSession(
+                headers=api_manager.DEFAULT_HEADERS,
+                connector=aiohttp.TCPConnector(limit=api_manager.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout))
+
+        endpoint = '/'.join([api_manager.ENDPOINT_JOBS, str(job_id)])
+        url = '/'.join([api_manager.host, endpoint, ''])
+
+        for retry in range(api_manager.retries + 1):
+            if retry:
+                await asyncio.sleep(api_manager.backoff_factor * (2 ** (retry - 1)))
+
+            started = time.time()
+            failed = True
+            try:
+                async with self.http_session.patch(url, data=json.dumps(data)) as response:
+                    failed = response.status >= 400
+                    if response.status in api_manager.RETRY_STATUSES and retry < api_manager.retries:
+                        continue
+                    return await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if retry == api_manager.retries:
+                    raise
+            finally:
+                api_manager.record_latency(endpoint, time.time() - started, failed)
+
+
+ENGINES = {
+    'process': ProcessEngine,
+    'asyncio': AsyncioEngine,
+}
+
+
+def build_engine(sync_manager, engine):
+    """ Returns the configured job engine """
+    if engine not in ENGINES:
+        raise Exception('Unknown job engine \'{0}\', expected one of: {1}'.format(engine, ', '.join(sorted(ENGINES))))
+
+    return ENGINES[engine](sync_manager)
@@ -0,0 +1,141 @@
+import os
+import mmap
+import hashlib
+import collections
+import concurrent.futures
+
+from lib import helper
+from lib import metrics
+from lib.config import ConfigManager
+
+
+class HashingEngine():
+    """
+    Hashes local files on all cores
+    hashlib lets go of the GIL while it hashes, so a thread pool keeps every core busy without having to
+    ship the files (or results) between processes
+    The files of each device are worked through by at most per_device threads, so a spinning disk isn't
+    made to seek between more files than it can stream
+    """
+
+    # Files at least this big are hashed straight out of a memory map, in MMAP_BLOCK_SIZE slices
+    MMAP_THRESHOLD = 64 * 1024 * 1024
+    MMAP_BLOCK_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, hashing_config=None):
+        """ Setup the pool sizes """
+        if hashing_config is None:
+            hashing_config = ConfigManager.default_section(ConfigManager.HASHING)
+
+        self.workers = int(hashing_config.workers) or os.cpu_count() or 1
+        self.per_device = int(hashing_config.per_device)
+
+    @classmethod
+    def hash_file(cls, path):
+        """ Returns the sha256 hex digest of the file """
+        size = os.stat(path).st_size
+        metrics.registry.inc('jqm_hashed_bytes_total', size)
+
+        with metrics.registry.timer('jqm_hash_seconds'):
+            return cls.digest_file(path, size)
+
+    @classmethod
+    def digest_file(cls, path, size):
+        """ Hashes the file of the given size, mapping it into memory if it's big """
+        if size < cls.MMAP_THRESHOLD:
+            return helper.hash_file(path)
+
+        digest = hashlib.sha256()
+        with open(path, 'rb', buffering=0) as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, 'madvise'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+                with memoryview(mapped) as view:
+                    for offset in range(0, len(mapped), cls.MMAP_BLOCK_SIZE):
+                        with view[offset:offset + cls.MMAP_BLOCK_SIZE] as block:
+                            digest.update(block)
+
+            return digest.hexdigest()
+
+    def hash_paths(self, paths, devices=None):
+        """
+        Hashes the files in parallel, returns a dict() of path -> hex digest (or the OSError hashing it raised)
+        devices being a dict() of path -> st_dev, any path left out is stat'd here
+        """
+        devices = devices or dict()
+        queues = collections.defaultdict(collections.deque)
+        digests = dict()
+
+        for path in paths:
+            try:
+                device = devices[path] if path in devices else os.stat(path).st_dev
+            except OSError as e:
+                digests[path] = e
+                continue
+
+            queues[device].append(path)
+
+        def drain(queue):
+            """ Hash the device's files until there are none left, deque.popleft being thread safe """
+            while True:
+                try:
+                    path = queue.popleft()
+                except IndexError:
+                    return
+
+                try:
+                    digests[path] = self.hash_file(path)
+                except OSError as e:
+                    digests[path] = e
+
+        # per_device lanes draining each device's files, run up to workers at a time
+        lanes = [queue for queue in queues.values() for _ in range(min(self.per_device or len(queue), len(queue)))]
+        if len(lanes) <= 1:
+            for queue in lanes:
+                drain(queue)
+            return digests
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.workers, len(lanes))) as executor:
+            for future in [executor.submit(drain, queue) for queue in lanes]:
+                future.result()
+
+        return digests
+
+    def verify(self, requests):
+        """
+        Answers a batch of the helper's verify requests, as helper.verify would, hashing the files in parallel
+        Returns the list() of responses in the order of the requests
+        """
+        responses = list()
+        to_hash = dict()
+
+        for request in requests:
+            path = request['path']
+            response = {'path': path, 'exists': False}
+            responses.append(response)
+
+            try:
+                response.update(helper.stat_file(path))
+            except OSError:
+                continue
+
+            response['exists'] = True
+            known = helper.known_hash(request.get('known'), response)
+
+            if known is not None:
+                response.update({'hash': known, 'cached': True})
+            else:
+                to_hash[path] = response['device']
+
+        digests = self.hash_paths(list(to_hash), devices=to_hash)
+
+        for response in responses:
+            if response['path'] in digests:
+                digest = digests[response['path']]
+                if isinstance(digest, OSError):
+                    response['error'] = str(digest)
+                else:
+                    response['hash'] = digest
+
+        return responses
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Stand-alone file helper that the SyncManager runs on a client
+
+The source of this module is sent to the client and run with 'python3 -c <source> <action>',
+so it must only ever use the standard library and must not import anything from lib/
+
+Requests are read from stdin and responses written to stdout, one JSON object per line.
+A response is flushed as soon as it's ready so the caller can stream them back in order.
+"""
+import os
+import sys
+import json
+import hashlib
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# The stat metadata that has to match for a previously computed hash to still be trusted
+STAT_FIELDS = ('size', 'mtime_ns', 'inode', 'device')
+
+
+def hash_file(path):
+    """ Returns the sha256 hex digest of the given file, read unbuffered into one reused block """
+    digest = hashlib.sha256()
+    block = bytearray(HASH_BLOCK_SIZE)
+    view = memoryview(block)
+
+    with open(path, 'rb', buffering=0) as f:
+        size = f.readinto(block)
+        while size:
+            digest.update(view[:size])
+            size = f.readinto(block)
+
+    return digest.hexdigest()
+
+
+def stat_file(path):
+    """ Returns the stat metadata we use to tell if a file has changed """
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino, 'device': stat.st_dev}
+
+
+def known_hash(known, stat):
+    """ Returns the known hash if the file's stat metadata still matches the one it was hashed with, or None """
+    if known and all(known.get(field) == stat[field] for field in STAT_FIELDS):
+        return known['hash']
+    return None
+
+
+def verify(request):
+    """
+    Reports the existence, stat metadata and hash of the requested path
+    If the request carries a 'known' stat + hash that still matches the file, that hash is trusted
+    instead of reading the whole file again
+    """
+    path = request['path']
+    response = {'path': path, 'exists': False}
+
+    try:
+        response.update(stat_file(path))
+    except OSError:
+        return response
+
+    response['exists'] = True
+    known = known_hash(request.get('known'), response)
+
+    if known is not None:
+        response.update({'hash': known, 'cached': True})
+        return response
+
+    try:
+        response['hash'] = hash_file(path)
+    except OSError as e:
+        response['error'] = str(e)
+
+    return response
+
+
+def manifest(request):
+    """
+    Reports the existence and stat metadata of the requested path without reading the file
+    The hash is only included when the request carries a 'known' stat + hash that still matches the file
+    """
+    path = request['path']
+    response = {'path': path, 'exists': False}
+
+    try:
+        response.update(stat_file(path))
+    except OSError:
+        return response
+
+    response['exists'] = True
+    known = known_hash(request.get('known'), response)
+
+    if known is not None:
+        response.update({'hash': known, 'cached': True})
+
+    return response
+
+
+def prune(directory, root):
+    """ Removes the directory and then its parents while they are empty, stopping short of root """
+    root = os.path.abspath(root)
+    directory = os.path.abspath(directory)
+    pruned = list()
+
+    while directory.startswith(root + os.sep):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+
+        pruned.append(directory)
+        directory = os.path.dirname(directory)
+
+    return pruned
+
+
+def delete(request):
+    """
+    Deletes the requested path and reports whether it's gone afterwards (going by a stat, not a rehash)
+    Given a 'root', the directories the path was in are pruned up to it while they are empty
+    """
+    path = request['path']
+    response = {'path': path}
+
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        response['error'] = str(e)
+
+    response['exists'] = os.path.lexists(path)
+
+    if request.get('root') and not response['exists']:
+        response['pruned'] = prune(os.path.dirname(path), request['root'])
+
+    return response
+
+
+ACTIONS = {
+    'verify': verify,
+    'manifest': manifest,
+    'delete': delete,
+}
+
+
+def main(argv):
+    """ Run the requested action over every request given on stdin """
+    if len(argv) < 2 or argv[1] not in ACTIONS:
+        sys.stderr.write('Usage: helper.py {{{0}}}\n'.format('|'.join(sorted(ACTIONS))))
+        return 2
+
+    action = ACTIONS[argv[1]]
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+
+        sys.stdout.write(json.dumps(action(json.loads(line))) + '\n')
+        sys.stdout.flush()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
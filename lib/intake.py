@@ -0,0 +1,203 @@
+import time
+import threading
+
+import requests
+
+
+class PollingIntake():
+    """
+    Fetches the job queue on an adaptive interval
+    Polls every min_sleep seconds while jobs are flowing, backing off up to sleep seconds while idle
+    """
+    BACKOFF = 2
+
+    def __init__(self, api_manager, daemon_config, logger):
+        """ Setup the polling interval bounds """
+        self.api_manager = api_manager
+        self.logger = logger
+
+        self.min_sleep = float(daemon_config.min_sleep)
+        self.max_sleep = float(daemon_config.sleep)
+        self.interval = self.min_sleep
+
+        self.fetched = time.time()
+        # Whether the last fetch failed, we back off before trying again
+        self.failed = False
+
+    def fetch(self, skip_job_ids):
+        """ Returns the pending job queue, an empty one if it can't be fetched """
+        self.fetched = time.time()
+        self.failed = False
+        try:
+            return self.api_manager.get_job_queue(skip_job_ids=skip_job_ids)
+        except (requests.RequestException, ValueError) as e:
+            return self.fetch_failed(e)
+
+    def fetch_failed(self, error):
+        """ Log the failed fetch, nothing is started off the queue we last saw as it may hold jobs we've finished """
+        self.logger.error('Unable to fetch the job queue ({0}), backing off'.format(error))
+        self.failed = True
+        return list()
+
+    def adapt(self, busy):
+        """ Tighten the interval while jobs are flowing, back off while idle """
+        if busy:
+            self.interval = self.min_sleep
+        else:
+            self.interval = min(self.interval * self.BACKOFF, self.max_sleep)
+
+    def wait(self, busy):
+        """ Wait until it's time to fetch the queue again, backing off after a failed fetch """
+        self.adapt(busy and not self.failed)
+
+        # Whatever time we spent fetching/handling the queue counts towards the interval
+        sleep_time = max(self.interval - (time.time() - self.fetched), 0)
+        self.logger.debug('Sleeping for {0:.1f} seconds'.format(sleep_time))
+        time.sleep(sleep_time)
+
+    def close(self):
+        """ Nothing to let go of """
+        pass
+
+
+class LongPollIntake(PollingIntake):
+    """
+    Long-polls the job queue, the server holds the request until the queue changes (or long_poll_wait passes)
+    Unchanged queues (304 on our ETag) reuse the jobs we already have
+    After a held request (or a changed queue) we ask again at once, the server doing the waiting
+    A server that answers straight away with the same queue just ends up being polled on the adaptive interval
+    """
+
+    def __init__(self, api_manager, daemon_config, logger):
+        """ Setup the long-poll wait and the ETag of the queue we have """
+        PollingIntake.__init__(self, api_manager, daemon_config, logger)
+
+        self.long_poll_wait = int(daemon_config.long_poll_wait)
+        self.etag = None
+        self.queue = list()
+
+        # Whether the last request was held (or brought a new queue), so we can ask again straight away
+        self.held = False
+
+    def fetch(self, skip_job_ids):
+        """ Returns the pending job queue once it changes, or the one we have if it doesn't in time """
+        self.fetched = time.time()
+        self.held = False
+        self.failed = False
+        try:
+            etag, queue = self.api_manager.long_poll_job_queue(self.etag, self.long_poll_wait)
+        except (requests.RequestException, ValueError) as e:
+            return self.fetch_failed(e)
+
+        # An immediate 304 is a server that knows ETags but doesn't hold, asking again at once would spin
+        self.held = time.time() - self.fetched >= self.long_poll_wait / 2.0 or \
+            (queue is not None and etag != self.etag)
+
+        if queue is None:
+            self.logger.debug('Job queue unchanged (ETag {0})'.format(self.etag))
+        else:
+            self.etag = etag
+            self.queue = queue
+
+        return self.api_manager.prepare_job_queue(self.queue, skip_job_ids)
+
+    def wait(self, busy):
+        """ Long-poll again at once if the server held on to the last request, back off if it didn't (or failed) """
+        if self.held:
+            self.adapt(True)
+            self.logger.debug('Long-polling the job queue again')
+            return
+
+        PollingIntake.wait(self, busy)
+
+
+class PushIntake(PollingIntake):
+    """
+    Listens on a server-sent events (SSE) stream and fetches the queue as soon as an event arrives
+    Falls back to the adaptive polling interval while the stream is down (reconnecting in the background)
+    """
+
+    def __init__(self, api_manager, daemon_config, logger):
+        """ Start listening on the push channel """
+        PollingIntake.__init__(self, api_manager, daemon_config, logger)
+
+        self.push_endpoint = daemon_config.push_endpoint
+        self.pushed = threading.Event()
+        self.running = True
+
+        # Threads don't make it through the daemon's forks, the listener is started on the first wait()
+        self.listener = None
+        # The listener's own connection, the main thread's session isn't shared with it
+        self.session = None
+
+    def start(self):
+        """ Start listening on the push channel """
+        self.session = self.api_manager.build_session()
+        self.listener = threading.Thread(target=self.listen, name='job-push-listener', daemon=True)
+        self.listener.start()
+
+    def listen(self):
+        """ Keep a connection open to the push endpoint, flagging every event we get """
+        retry = self.min_sleep
+
+        while self.running:
+            try:
+                response = self.api_manager.request('GET', self.push_endpoint, stream=True,
+                                                    headers=dict(self.api_manager.DEFAULT_HEADERS,
+                                                                 Accept='text/event-stream'),
+                                                    timeout=(self.api_manager.timeout[0], None),
+                                                    session=self.session)
+                response.raise_for_status()
+                self.logger.info('Listening for pushed jobs on {0}'.format(self.push_endpoint))
+                retry = self.min_sleep
+
+                for line in response.iter_lines(decode_unicode=True):
+                    if not self.running:
+                        break
+                    # Every event ends with a data line, that's all we need to know to go and fetch the queue
+                    if line and line.startswith('data:'):
+                        self.pushed.set()
+            except Exception as e:
+                self.logger.warning('Push channel {0} dropped ({1}), polling until it is back'.format(
+                    self.push_endpoint, e))
+
+            if self.running:
+                time.sleep(retry)
+                retry = min(retry * self.BACKOFF, self.max_sleep)
+
+    def wait(self, busy):
+        """ Wait for a pushed event, or until the polling interval is up """
+        if self.listener is None:
+            self.start()
+
+        self.adapt(busy)
+
+        sleep_time = max(self.interval - (time.time() - self.fetched), 0)
+        self.logger.debug('Waiting up to {0:.1f} seconds for pushed jobs'.format(sleep_time))
+
+        if self.pushed.wait(timeout=sleep_time):
+            self.logger.debug('Woken up by a pushed job')
+        self.pushed.clear()
+
+    def close(self):
+        """ Stop listening """
+        self.running = False
+
+        if self.session is not None:
+            self.session.close()
+
+
+INTAKES = {
+    'poll': PollingIntake,
+    'longpoll': LongPollIntake,
+    'push': PushIntake,
+}
+
+
+def build_intake(api_manager, daemon_config, logger):
+    """ Returns the job intake configured in the DAEMON section """
+    if daemon_config.intake not in INTAKES:
+        raise Exception('Unknown job intake \'{0}\', expected one of: {1}'.format(daemon_config.intake,
+                                                                                 ', '.join(sorted(INTAKES))))
+
+    return INTAKES[daemon_config.intake](api_manager, daemon_config, logger)
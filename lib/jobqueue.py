@@ -1,12 +1,19 @@
 import os
 import sys
-import time
 import atexit
 
 # Program imports
+from lib import metrics
 from lib.logger import Logger
 from lib.api import FrontendApiManager
 from lib.sync import SyncManager
+from lib.ssh import SshConnectionPool
+from lib.slots import SlotScheduler
+from lib.scheduler import JobScheduler
+from lib.hashing import HashingEngine
+from lib.bandwidth import BandwidthGovernor
+from lib.intake import build_intake
+from lib.compression import CompressionPolicy
 
 
 class JobQueueManager():
@@ -21,16 +28,39 @@ class JobQueueManager():
 
         self.running = True
 
-        self.logger = Logger(self.config.DAEMON.log_name,
-                             self.config.DAEMON.log_dir).get_logger()
+        self.log = Logger(self.config.DAEMON.log_name, self.config.DAEMON.log_dir, self.config.DAEMON)
+        self.logger = self.log.get_logger()
 
         self.pidfile = self.config.DAEMON.pid_file
 
+        self.config.API.availability_cache_file = self.state_file(self.config.API.availability_cache_file)
+        self.config.SYNC.hash_cache_file = self.state_file(self.config.SYNC.hash_cache_file)
+        self.config.SYNC.checkpoint_file = self.state_file(self.config.SYNC.checkpoint_file)
+        self.config.SSH.control_dir = self.state_file(self.config.SSH.control_dir)
+
         self.api_manager = FrontendApiManager(self.config.API, logger=self.logger)
-        self.sync_manager = SyncManager(self.api_manager, logger=self.logger)
+        self.ssh_pool = SshConnectionPool(self.config.SSH, logger=self.logger)
+        self.sync_manager = SyncManager(self.api_manager, logger=self.logger, sync_config=self.config.SYNC,
+                                        ssh_pool=self.ssh_pool,
+                                        compression_policy=CompressionPolicy(self.config.COMPRESSION, self.logger),
+                                        slot_scheduler=SlotScheduler(self.config.SLOTS, self.logger),
+                                        hashing_engine=HashingEngine(self.config.HASHING),
+                                        bandwidth_governor=BandwidthGovernor(self.config.BANDWIDTH, self.logger))
+        self.intake = build_intake(self.api_manager, self.config.DAEMON, self.logger)
+        self.scheduler = JobScheduler(self.config.SCHEDULER, self.logger)
+
+    def state_file(self, path):
+        """ Returns where a file we keep state in goes, relative paths being in the log directory """
+        if not path or os.path.isabs(path):
+            return path
+
+        return os.path.join(os.path.dirname(self.logger.log_file), path)
 
     def daemonize(self):
         """ Turn this running process into a deamon """
+        # The log listener thread won't make it through the forks, records are written directly until it's back
+        self.log.stop()
+
         # Perform first fork
         try:
             pid = os.fork()
@@ -69,6 +99,8 @@ class JobQueueManager():
         os.dup2(so.fileno(), sys.stdout.fileno())
         os.dup2(se.fileno(), sys.stderr.fileno())
 
+        self.log.start()
+
         # Register the pid file deletion
         atexit.register(self.on_exit)
 
@@ -87,29 +119,40 @@ class JobQueueManager():
         """ Main worker loop """
         while self.running:
             # Loop over the job queue and handle any jobs that we are not processing yet
-            job_queue = self.api_manager.get_job_queue()
+            job_queue = self.intake.fetch(skip_job_ids=self.sync_manager.processing_job_ids)
 
             if not job_queue:
                 self.logger.info('Job queue empty')
 
+            # Start the most pressing jobs first, sharing the slots out between the destination clients
+            job_queue = self.scheduler.order(job_queue, skip_job_ids=self.sync_manager.processing_job_ids,
+                                             running=self.sync_manager.slots.by_client)
+
+            metrics.registry.set('jqm_pending_jobs', len(job_queue))
+
+            started_jobs = 0
             for job in job_queue:
                 try:
                     self.sync_manager.handle(job)
                     self.logger.info('Starting job {0}'.format(job['name']))
+                    started_jobs += 1
                 except self.sync_manager.AlreadyWorkingOnException:
                     self.logger.debug('Already working on job {0}'.format(job['name']))
-                except self.sync_manager.ActionAlreadyWorkingOnException:
-                    self.logger.debug("action='{0}' job='{1}' message='action already working on'".format(
-                        job['action'], job['name']))
+                except SlotScheduler.NoSlotException as e:
+                    self.logger.debug("action='{0}' job='{1}' message='no free slot ({2})'".format(
+                        job['action'], job['name'], e))
 
             # Go over all queued jobs and complete any finished ones, report on what jobs we finished off
             for job in self.sync_manager.complete_jobs():
                 self.logger.info('Removed finished job {0}'.format(job))
 
-            # Sleep for a set time before checking the queue again
-            sleep_time = float(self.config.DAEMON.sleep)
-            self.logger.debug('Sleeping for {0} seconds'.format(sleep_time))
-            time.sleep(sleep_time)
+            self.sync_manager.slots.report()
+            metrics.registry.set('jqm_processing_jobs', len(self.sync_manager.processing_queue))
+            for action in self.sync_manager.slots.max_per_action:
+                metrics.registry.set('jqm_slots_used', self.sync_manager.slots.by_action[action], action=action)
+
+            # Wait for new jobs, checking back sooner while jobs are flowing
+            self.intake.wait(busy=started_jobs or self.sync_manager.processing_queue)
 
         if not self.running:
             # Good-ish place to be in
@@ -147,6 +190,9 @@ class JobQueueManager():
             print('INFO: Skipping daemon mode')
             print('INFO: Log file: {0}'.format(self.logger.log_file))
 
+        # Served from the (daemonized) process that runs the jobs, the forked jobs send theirs on to us
+        metrics.registry.configure(self.config.METRICS)
+
         # Work our magic
         self.run()
 
@@ -177,11 +223,18 @@ class JobQueueManager():
             self.logger.info('Removed finished job {0}'.format(job))
 
         # Go over all currently running jobs, report on them and then kill them.
-        for process in self.sync_manager.processing_queue:
+        for job_id, process in list(self.sync_manager.processing_job_ids.items()):
             self.logger.info('Still processing job {0}'.format(process.name))
 
-            # We now kill off the process, upon restart the job should restart again
+            # We now kill off the process, upon restart the job should restart again (from its checkpoint)
             self.logger.warning('Killing job {0}'.format(process.name))
             process.terminate()
+            self.api_manager.update_job_state(job_id, 'PEND')
 
+        self.sync_manager.engine.stop()
+        self.intake.close()
+        self.ssh_pool.close_all()
+        self.api_manager.close()
+        metrics.registry.close()
         self.running = False
+        self.log.stop()
@@ -0,0 +1,93 @@
+import os
+import time
+import sqlite3
+import threading
+import collections
+
+
+class CheckpointJournal():
+    """
+    Records how far each job got with each of its files, so a job restarted after the daemon was stopped
+    picks up where it left off instead of verifying and sending the whole package again
+    Kept in a SQLite database shared by the job processes, a blank path turns checkpointing off
+    """
+
+    # The source file was verified
+    VERIFIED = 'verified'
+    # rsync sent the file to the destination
+    TRANSFERRED = 'transferred'
+    # The destination file's hash was confirmed
+    CONFIRMED = 'confirmed'
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS checkpoints ('
+              'job_id INTEGER NOT NULL, client_id INTEGER NOT NULL, file_id INTEGER NOT NULL, '
+              'state TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY (job_id, client_id, file_id))')
+
+    def __init__(self, path=None):
+        """ Setup the journal, the database is opened on first use """
+        self.path = path
+
+        self._connection = None
+        self._connection_pid = None
+
+        # Transfers within a job run on threads that share the connection
+        self.lock = threading.RLock()
+
+    @property
+    def connection(self):
+        """
+        Returns the database connection of this process
+        A forked job must not share the parent's connection, so it opens its own on first use
+        """
+        if self._connection is None or self._connection_pid != os.getpid():
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(self.SCHEMA)
+            self._connection.commit()
+            self._connection_pid = os.getpid()
+
+        return self._connection
+
+    def record(self, job_id, client, file_ids, state):
+        """ Checkpoint the files of the job as having reached the state on the client """
+        if not self.path or not file_ids:
+            return
+
+        now = time.time()
+
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?)',
+                                        [(job_id, client['id'], file_id, state, now) for file_id in file_ids])
+            self.connection.commit()
+
+    def files(self, job_id, client, state):
+        """ Returns the set() of file ids of the job checkpointed in the state on the client """
+        if not self.path:
+            return set()
+
+        with self.lock:
+            rows = self.connection.execute('SELECT file_id FROM checkpoints WHERE job_id = ? AND client_id = ? '
+                                           'AND state = ?', (job_id, client['id'], state))
+            return set(file_id for file_id, in rows)
+
+    def progress(self, job_id):
+        """ Returns a Counter of the job's files in each state """
+        if not self.path:
+            return collections.Counter()
+
+        with self.lock:
+            rows = self.connection.execute('SELECT state, COUNT(*) FROM checkpoints WHERE job_id = ? GROUP BY state',
+                                           (job_id,))
+            return collections.Counter(dict(rows))
+
+    def finish(self, job_id):
+        """ The job is done with, drop its checkpoints """
+        if not self.path:
+            return
+
+        with self.lock:
+            self.connection.execute('DELETE FROM checkpoints WHERE job_id = ?', (job_id,))
+            self.connection.commit()
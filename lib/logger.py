@@ -1,5 +1,11 @@
 import os
+import json
+import queue
 import logging
+import logging.handlers
+import multiprocessing
+
+from lib.config import ConfigManager
 
 
 class Logger():
@@ -10,14 +16,25 @@ class Logger():
     Logger.warning()
     Logger.error()
     Logger.critical()
+
+    Records are put on a queue (shared with the forked jobs) and written to the log file by a single listener
+    thread of the daemon, so logging never waits on the disk and the jobs don't write over each other
     """
 
-    def __init__(self, title, log_destination):
+    ROTATE_SIZE = 'size'
+    ROTATE_TIME = 'time'
+
+    FORMAT_JSON = 'json'
+
+    def __init__(self, title, log_destination, log_config=None):
         """
         Setup the logger
         """
+        if log_config is None:
+            log_config = ConfigManager.default_section(ConfigManager.DAEMON)
+
         self.logger = logging.getLogger(title)
-        self.logger.setLevel(logging.DEBUG)
+        self.logger.setLevel(logging.getLevelName(log_config.log_level.upper()))
 
         # If it's a relative path add it onto the scripts working directory
         if log_destination.startswith('.'):
@@ -27,17 +44,95 @@ class Logger():
         log_destination = os.path.normpath(os.path.join(log_destination, '{0}.log'.format(title)))
 
         self.logger.log_file = log_destination
-        fh = logging.FileHandler(log_destination)
-        fh.setLevel(logging.DEBUG)
+        self.handler = self.build_handler(log_destination, log_config)
 
-        formatter = logging.Formatter('timestamp="%(asctime)s" name="%(name)s" ' +
-                                      'level="%(levelname)s" message="%(message)s"')
+        if log_config.log_format == self.FORMAT_JSON:
+            self.handler.setFormatter(JsonFormatter())
+        else:
+            self.handler.setFormatter(logging.Formatter('timestamp="%(asctime)s" name="%(name)s" ' +
+                                                        'level="%(levelname)s" message="%(message)s"'))
 
-        fh.setFormatter(formatter)
-        self.logger.addHandler(fh)
+        self.queue_handler = QueueHandler(self.handler)
+        self.logger.addHandler(self.queue_handler)
+        self.listener = None
+        self.start()
 
         self.logger.debug('Logging is now set up')
-        self.logger.info('Log File: {0}'.format(log_destination))
+        self.logger.info('Log File: %s', log_destination)
+
+    def build_handler(self, log_destination, log_config):
+        """ Returns the handler writing the log file, rotated by size or time if configured to """
+        if log_config.log_rotate == self.ROTATE_SIZE:
+            return logging.handlers.RotatingFileHandler(log_destination, maxBytes=int(log_config.log_max_bytes),
+                                                        backupCount=int(log_config.log_backups))
+        elif log_config.log_rotate == self.ROTATE_TIME:
+            return logging.handlers.TimedRotatingFileHandler(log_destination, when=log_config.log_when,
+                                                             backupCount=int(log_config.log_backups))
+        else:
+            return logging.FileHandler(log_destination)
+
+    def start(self):
+        """
+        Start the listener writing the queued records out, on a fresh queue
+        Called again after the daemon forks itself, as the listener thread doesn't survive a bare os.fork
+        """
+        self.queue_handler.queue = multiprocessing.Queue()
+        self.listener = logging.handlers.QueueListener(self.queue_handler.queue, self.handler,
+                                                       respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """ Write out what's queued and stop the listener, records are written straight to the file until start() """
+        if self.listener is None:
+            return
+
+        self.queue_handler.queue = None
+        self.listener.stop()
+        self.listener = None
 
     def get_logger(self):
         return self.logger
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """ Queues the records for the listener, writing them out itself while there's no listener """
+
+    def __init__(self, target):
+        logging.handlers.QueueHandler.__init__(self, None)
+        self.target = target
+
+    def enqueue(self, record):
+        """ Never waits, a full queue (or one that's gone) loses the record rather than hold up a transfer """
+        if self.queue is None:
+            self.target.handle(record)
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except (queue.Full, ValueError, OSError):
+            pass
+
+
+class JsonFormatter(logging.Formatter):
+    """ A JSON object per line """
+
+    def format(self, record):
+        entry = {
+            'timestamp': self.formatTime(record),
+            'name': record.name,
+            'level': record.levelname,
+            'process': record.process,
+            'message': record.getMessage(),
+        }
+
+        return json.dumps(entry)
+
+
+class CommandLine():
+    """ A command (list) that is only joined into a line if the record it's logged in is written """
+
+    def __init__(self, command):
+        self.command = command
+
+    def __str__(self):
+        return ' '.join(self.command)
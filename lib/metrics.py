@@ -0,0 +1,243 @@
+import os
+import time
+import bisect
+import threading
+import contextlib
+import http.server
+import multiprocessing
+
+# name -> (type, help) of every metric we keep
+METRICS = {
+    'jqm_api_request_seconds': ('histogram', 'Frontend API request latency by endpoint'),
+    'jqm_ssh_command_seconds': ('histogram', 'Commands run on the clients, over ssh for remote clients'),
+    'jqm_hash_seconds': ('histogram', 'Hashing a local file'),
+    'jqm_hashed_bytes_total': ('counter', 'Bytes of local files hashed'),
+    'jqm_rsync_seconds': ('histogram', 'rsync runs by transfer mode'),
+    'jqm_transferred_bytes_total': ('counter', 'Bytes rsync sent between the clients'),
+    'jqm_jobs_started_total': ('counter', 'Jobs started by action'),
+    'jqm_jobs_finished_total': ('counter', 'Jobs finished by action'),
+    'jqm_jobs_failed_total': ('counter', 'Jobs failed by action'),
+    'jqm_pending_jobs': ('gauge', 'Jobs pending in the last fetched queue'),
+    'jqm_processing_jobs': ('gauge', 'Jobs being processed'),
+    'jqm_slots_used': ('gauge', 'Job slots in use by action'),
+}
+
+# Upper bounds (seconds) of the histogram buckets, from quick API calls up to hour long rsyncs
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+
+class MetricsRegistry():
+    """
+    Keeps the counters, gauges and histograms and serves them in the Prometheus text format
+    A forked job keeps its own deltas and sends them to the parent every flush_interval seconds (and when
+    it's done), where a collector thread adds them into the parent's view
+    Until it's configured with a port everything is a no-op
+    """
+
+    def __init__(self):
+        """ Disabled until configure() """
+        self.enabled = False
+        self.flush_interval = 5.0
+
+        # (name, sorted label items) -> value, or [bucket counts..., sum, count] of a histogram
+        self.values = dict()
+        self.lock = threading.Lock()
+
+        # The process that was configured (and serves the metrics), and the process the values belong to
+        self.owner = os.getpid()
+        self.pid = os.getpid()
+        self.flushed = time.time()
+
+        self.queue = None
+        self.collector = None
+        self.server = None
+
+    def configure(self, metrics_config):
+        """ Enable the metrics if a port is configured, must be called before any job forks """
+        if not metrics_config.port or self.enabled:
+            return
+
+        self.enabled = True
+        self.flush_interval = float(metrics_config.flush_interval)
+        self.owner = self.pid = os.getpid()
+
+        self.queue = multiprocessing.SimpleQueue()
+        self.collector = threading.Thread(target=self.collect, name='metrics-collector', daemon=True)
+        self.collector.start()
+
+        self.server = http.server.ThreadingHTTPServer((metrics_config.address, int(metrics_config.port)),
+                                                      self.handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True).start()
+
+    def close(self):
+        """ Stop serving and collecting """
+        if not self.enabled or self.worker:
+            return
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.queue.put(None)
+        self.collector.join(timeout=5)
+        self.enabled = False
+
+    @property
+    def worker(self):
+        """ Are we a forked job, whose values start off empty (not the parent's) so they hold just our deltas """
+        if os.getpid() != self.pid:
+            # The lock may have been held by another of the parent's threads as we forked
+            self.lock = threading.Lock()
+            self.values = dict()
+            self.pid = os.getpid()
+            self.flushed = time.time()
+
+        return self.pid != self.owner
+
+    def inc(self, name, amount=1, **labels):
+        """ Add to the counter """
+        if not self.enabled:
+            return
+
+        worker = self.worker
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+        if worker:
+            self.maybe_flush()
+
+    def set(self, name, value, **labels):
+        """ Set the gauge, only the parent's gauges are kept """
+        if not self.enabled or self.worker:
+            return
+
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, seconds, **labels):
+        """ Add the observation to the histogram """
+        if not self.enabled:
+            return
+
+        worker = self.worker
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = [0] * (len(BUCKETS) + 3)
+
+            histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+        if worker:
+            self.maybe_flush()
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """ Observe how long the block took """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started, **labels)
+
+    def maybe_flush(self):
+        """ Send our deltas on if it has been flush_interval seconds since we last did """
+        if time.time() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ A forked job sends its deltas to the parent """
+        if not self.enabled or not self.worker:
+            return
+
+        with self.lock:
+            values, self.values = self.values, dict()
+            self.flushed = time.time()
+
+        if values:
+            self.queue.put(values)
+
+    def collect(self):
+        """ Add the deltas sent by the forked jobs into our values, until we're closed """
+        while True:
+            values = self.queue.get()
+            if values is None:
+                return
+
+            with self.lock:
+                for key, value in values.items():
+                    if isinstance(value, list):
+                        histogram = self.values.setdefault(key, [0] * len(value))
+                        for i, delta in enumerate(value):
+                            histogram[i] += delta
+                    else:
+                        self.values[key] = self.values.get(key, 0) + value
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        """ Returns the {name="value",...} of the labels, blank if there are none """
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+
+        return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                              for name, value in labels) + '}'
+
+    def render(self):
+        """ Returns the metrics in the Prometheus text exposition format """
+        with self.lock:
+            values = sorted((key, list(value) if isinstance(value, list) else value)
+                            for key, value in self.values.items())
+
+        lines = list()
+        described = set()
+
+        for (name, labels), value in values:
+            kind, description = METRICS.get(name, ('untyped', ''))
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP {0} {1}'.format(name, description))
+                lines.append('# TYPE {0} {1}'.format(name, kind))
+
+            if kind != 'histogram':
+                lines.append('{0}{1} {2}'.format(name, self.format_labels(labels), value))
+                continue
+
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), value):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(name, self.format_labels(labels, [('le', bound)]), cumulative))
+            lines.append('{0}_sum{1} {2}'.format(name, self.format_labels(labels), value[-2]))
+            lines.append('{0}_count{1} {2}'.format(name, self.format_labels(labels), value[-1]))
+
+        return '\n'.join(lines) + '\n'
+
+    def handler(self):
+        """ Returns the request handler class serving /metrics """
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            """ GET /metrics """
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0].rstrip('/') not in ('', '/metrics'):
+                    self.send_error(404)
+                    return
+
+                payload = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+
+# The daemon's metrics, configured by the JobQueueManager
+registry = MetricsRegistry()
@@ -0,0 +1,163 @@
+import re
+import time
+import threading
+
+
+class ProgressTracker():
+    """
+    Adds up the bytes of every transfer of a job and reports the job's progress (percent, bytes/s, ETA)
+    Reports are rate limited to one every interval seconds, each carrying just the latest figures
+    """
+
+    def __init__(self, job_id, total, send, interval, logger=None):
+        """ send(job_id, progress) being what gets the progress to the API """
+        self.job_id = job_id
+        self.total = total
+        self.send = send
+        self.interval = interval
+        self.logger = logger
+
+        # Bytes of the files that were already there or have been sent, and of the files being sent right now
+        self.done = 0
+        self.sent = 0
+        self.in_flight = dict()
+
+        self.started = None
+        self.reported = 0
+        self.reports = 0
+
+        # Transfers within a job run on threads that share the tracker
+        self.lock = threading.Lock()
+
+    def skip(self, size):
+        """ Files the destination already has count towards the progress, but not the rate """
+        with self.lock:
+            self.done += size
+        self.report()
+
+    def transferring(self, key, sent):
+        """ The transfer (key) has sent this many bytes of its file so far """
+        with self.lock:
+            if self.started is None:
+                self.started = time.time()
+            self.in_flight[key] = sent
+        self.report()
+
+    def transferred(self, key, size=None):
+        """ The transfer (key) is over, size being the bytes sent if we know better than the last progress """
+        with self.lock:
+            sent = self.in_flight.pop(key, 0)
+            if size is not None:
+                sent = size
+            self.done += sent
+            self.sent += sent
+        self.report()
+
+    def progress(self):
+        """ Returns the dict() of the job's progress, rate and ETA """
+        with self.lock:
+            in_flight = sum(self.in_flight.values())
+            done = self.done + in_flight
+            elapsed = time.time() - self.started if self.started else 0
+            rate = (self.sent + in_flight) / elapsed if elapsed > 0 else 0
+
+        percent = min(100.0, 100.0 * done / self.total) if self.total else 0.0
+        eta = max(self.total - done, 0) / rate if rate else None
+
+        return {'progress': round(percent, 1), 'rate': int(rate), 'eta': int(eta) if eta is not None else None}
+
+    def report(self, force=False):
+        """ Send the latest progress if it has been interval seconds since the last report (or we're forced to) """
+        with self.lock:
+            now = time.time()
+            if not force and now - self.reported < self.interval:
+                return
+            self.reported = now
+            self.reports += 1
+
+        progress = self.progress()
+
+        try:
+            self.send(self.job_id, progress)
+        except Exception as e:
+            # Progress is nice to have, it's never worth failing the transfer over
+            if self.logger:
+                self.logger.warning('Unable to report the progress of job {0} ({1})'.format(self.job_id, e))
+
+
+class RsyncProgressParser():
+    """
+    Parses rsync's --progress output as it arrives, feeding each file's progress to a ProgressTracker
+    Progress updates are separated by carriage returns, everything else rsync prints is kept as the output
+    """
+
+    # '    1,234,567  45%   12.34MB/s    0:00:12' (followed by '(xfr#1, to-chk=0/1)' once the file is done)
+    PROGRESS = re.compile(r'^\s*([\d,]+)\s+(\d+)%\s+\S+/s\s+\S+')
+
+    def __init__(self, tracker=None, key=None, file_pattern=None):
+        """
+        key is the file being sent when rsync is sending just the one
+        file_pattern matches (with the relative path as group 1) the line that starts each file when sending many
+        """
+        self.tracker = tracker
+        self.key = key
+        self.file_pattern = file_pattern
+
+        self.partial = ''
+        self.lines = list()
+
+        # Bytes sent of the file being sent, in total since the last take() and in total
+        self.file_sent = 0
+        self.unmetered = 0
+        self.total_sent = 0
+
+    def feed(self, data):
+        """ Parse the next piece of rsync's output """
+        records = re.split(r'[\r\n]', self.partial + data)
+        self.partial = records.pop()
+
+        for record in records:
+            self.parse(record)
+
+    def parse(self, record):
+        """ Parse one carriage return/newline separated record """
+        match = self.PROGRESS.match(record)
+        if match:
+            sent = int(match.group(1).replace(',', ''))
+            self.unmetered += max(sent - self.file_sent, 0)
+            self.total_sent += max(sent - self.file_sent, 0)
+            self.file_sent = sent
+
+            if self.tracker and self.key is not None:
+                self.tracker.transferring(self.key, sent)
+            return
+
+        if self.file_pattern:
+            match = self.file_pattern.match(record)
+            if match:
+                self.next_file(match.group(1))
+
+        if record:
+            self.lines.append(record)
+
+    def next_file(self, key):
+        """ rsync moved on to the next file, so the one before is done """
+        if self.tracker and self.key is not None:
+            self.tracker.transferred(self.key)
+        self.key = key
+        self.file_sent = 0
+
+    def take(self):
+        """ Returns the bytes sent since the last take() """
+        sent, self.unmetered = self.unmetered, 0
+        return sent
+
+    def close(self):
+        """ The output is over, returns everything but the progress """
+        if self.partial:
+            self.parse(self.partial)
+            self.partial = ''
+
+        self.next_file(None)
+
+        return '\n'.join(self.lines) + '\n' if self.lines else ''
@@ -0,0 +1,132 @@
+import time
+import heapq
+import collections
+
+from lib.config import ConfigManager
+from lib.compression import CompressionPolicy
+
+
+class JobScheduler():
+    """
+    Decides the order the pending jobs are started in
+    Jobs go by priority (raised the longer they wait, so nothing starves) and then the cheapest first,
+    taking turns between the destination clients so one busy client can't hold up the others
+    """
+
+    Entry = collections.namedtuple('Entry', ['job', 'priority', 'effective', 'cost', 'waited'])
+
+    def __init__(self, scheduler_config=None, logger=None):
+        """ Setup the aging and cost estimate settings """
+        if scheduler_config is None:
+            scheduler_config = ConfigManager.default_section(ConfigManager.SCHEDULER)
+
+        self.logger = logger
+        self.aging = float(scheduler_config.aging)
+        self.lan_rate = int(scheduler_config.lan_rate)
+
+        # job_id -> when we first saw the job pending
+        self.first_seen = dict()
+
+        # package_id -> size of the package, its files are paged in off the API so they're only added up once
+        self.sizes = dict()
+
+    def package_size(self, package):
+        """
+        Returns the size of the package, noting it on the package for the job to size its progress by
+        None if the API doesn't give the size of every file, the job then sizes the package off the client
+        """
+        if package['id'] not in self.sizes:
+            size = 0
+            for package_file in package.get('package_files', ()):
+                if package_file.get('file_size') is None:
+                    size = None
+                    break
+                size += package_file['file_size']
+            self.sizes[package['id']] = size
+
+        package['package_size'] = self.sizes[package['id']]
+        return package['package_size']
+
+    def estimate_cost(self, job):
+        """ Returns the estimated seconds the job will take, from the package size and the client bandwidth """
+        size = self.package_size(job['package']) or 0
+
+        # Only a SYNC goes over the link between the clients, the others are bound by the client's disks
+        rate = 0
+        if job['action'] == 'SYNC':
+            rate = CompressionPolicy.bandwidth(job['source_client'], job['destination_client'])
+
+        return size / ((rate or self.lan_rate) * 1024)
+
+    def entry(self, job, now):
+        """ Returns the scheduling Entry of the job """
+        waited = now - self.first_seen.setdefault(job['id'], now)
+        priority = job.get('priority') or 0
+
+        # Every aging seconds spent waiting counts as one more priority level
+        effective = priority + (waited / self.aging if self.aging else 0)
+
+        return self.Entry(job, priority, effective, self.estimate_cost(job), waited)
+
+    @staticmethod
+    def head(entry, share, client_id):
+        """ Returns the heap key of a client's next job """
+        return -int(entry.effective), share, entry.cost, client_id
+
+    def order(self, job_queue, skip_job_ids=(), running=None):
+        """
+        Returns the jobs we aren't processing yet in the order they should be started
+        running being a mapping of destination client id -> jobs already running to it
+        """
+        now = time.time()
+        running = collections.Counter(running or dict())
+
+        # Forget about the jobs that are no longer pending
+        pending_ids = set(job['id'] for job in job_queue)
+        for job_id in [job_id for job_id in self.first_seen if job_id not in pending_ids]:
+            del self.first_seen[job_id]
+
+        pending_package_ids = set(job['package']['id'] for job in job_queue)
+        for package_id in [package_id for package_id in self.sizes if package_id not in pending_package_ids]:
+            del self.sizes[package_id]
+
+        # Each destination client's jobs, best first
+        per_client = collections.defaultdict(list)
+        for job in job_queue:
+            if job['id'] in skip_job_ids:
+                continue
+            per_client[job['destination_client']['id']].append(self.entry(job, now))
+
+        for entries in per_client.values():
+            entries.sort(key=lambda entry: (-entry.effective, entry.cost, entry.job['id']))
+
+        # A higher (whole) priority level always goes first, within a level the client with the fewest jobs
+        # running (and picked so far) gets the next turn
+        heads = [self.head(entries[0], running[client_id], client_id) for client_id, entries in per_client.items()]
+        heapq.heapify(heads)
+        ordered = list()
+
+        while heads:
+            _, share, _, client_id = heapq.heappop(heads)
+            entries = per_client[client_id]
+            ordered.append(entries.pop(0))
+
+            if entries:
+                heapq.heappush(heads, self.head(entries[0], share + 1, client_id))
+
+        self.log(ordered)
+        return [entry.job for entry in ordered]
+
+    def log(self, ordered):
+        """ Log the scheduling decision """
+        if not self.logger or not ordered:
+            return
+
+        self.logger.info('Scheduled {0} pending job(s) across {1} destination client(s), order: {2}'.format(
+            len(ordered), len(set(entry.job['destination_client']['id'] for entry in ordered)),
+            ' '.join(str(entry.job['id']) for entry in ordered)))
+
+        for position, entry in enumerate(ordered, 1):
+            self.logger.debug("schedule={0} job='{1}' priority={2} effective={3:.2f} waited={4:.0f}s "
+                              "cost={5:.1f}s".format(position, entry.job['name'], entry.priority, entry.effective,
+                                                     entry.waited, entry.cost))
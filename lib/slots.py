@@ -0,0 +1,108 @@
+import collections
+
+from lib.config import ConfigManager
+
+
+class SlotScheduler():
+    """
+    Hands out the slots jobs run in, capped in total, per action and per destination client
+    A limit of 0 leaves that dimension uncapped
+    """
+
+    class NoSlotException(Exception):
+        """ Every slot the job could run in is taken """
+        pass
+
+    def __init__(self, slots_config=None, logger=None):
+        """ Setup the limits and the (empty) occupancy counters """
+        if slots_config is None:
+            slots_config = ConfigManager.default_section(ConfigManager.SLOTS)
+
+        self.logger = logger
+        self.max_jobs = int(slots_config.max_jobs)
+        self.max_per_client = int(slots_config.max_per_client)
+        self.max_per_action = {
+            'SYNC': int(slots_config.max_sync),
+            'DEL': int(slots_config.max_del),
+            'INDEX': int(slots_config.max_index),
+        }
+
+        # job_id -> (action, destination client id) of every job holding a slot
+        self.holders = dict()
+        self.by_action = collections.Counter()
+        self.by_client = collections.Counter()
+
+        # How often each limit turned a job away, for sizing the limits
+        self.rejections = collections.Counter()
+
+    def __len__(self):
+        return len(self.holders)
+
+    def __contains__(self, job_id):
+        return job_id in self.holders
+
+    @staticmethod
+    def job_key(job):
+        """ Returns the (action, destination client id) the job takes a slot of """
+        return job['action'], job['destination_client']['id']
+
+    def blocked_by(self, job):
+        """ Returns the name of the limit keeping the job from running, or None if there's a slot free """
+        action, client_id = self.job_key(job)
+
+        if self.max_jobs and len(self.holders) >= self.max_jobs:
+            return 'max_jobs'
+        if self.max_per_action.get(action) and self.by_action[action] >= self.max_per_action[action]:
+            return 'max_{0}'.format(action.lower())
+        if self.max_per_client and self.by_client[client_id] >= self.max_per_client:
+            return 'max_per_client'
+
+        return None
+
+    def acquire(self, job):
+        """ Take a slot for the job, raises NoSlotException (naming the limit) if there isn't one """
+        limit = self.blocked_by(job)
+        if limit:
+            self.rejections[limit] += 1
+            raise self.NoSlotException(limit)
+
+        action, client_id = self.holders[job['id']] = self.job_key(job)
+        self.by_action[action] += 1
+        self.by_client[client_id] += 1
+
+    def release(self, job_id):
+        """ Hand back the job's slot """
+        if job_id not in self.holders:
+            return
+
+        action, client_id = self.holders.pop(job_id)
+
+        self.by_action[action] -= 1
+        if not self.by_action[action]:
+            del self.by_action[action]
+
+        self.by_client[client_id] -= 1
+        if not self.by_client[client_id]:
+            del self.by_client[client_id]
+
+    def occupancy(self):
+        """ Returns the slots in use against their limits, along with how often each limit turned jobs away """
+        return {
+            'jobs': (len(self.holders), self.max_jobs),
+            'actions': {action: (self.by_action[action], limit) for action, limit in self.max_per_action.items()},
+            'clients': {client_id: (count, self.max_per_client) for client_id, count in self.by_client.items()},
+            'rejections': dict(self.rejections),
+        }
+
+    def report(self):
+        """ Log the occupancy as a single key=value line """
+        if not self.logger:
+            return
+
+        actions = ' '.join('{0}={1}/{2}'.format(action.lower(), used, limit or '-')
+                           for action, (used, limit) in sorted(self.occupancy()['actions'].items()))
+        clients = ','.join('{0}:{1}'.format(client_id, count) for client_id, count in sorted(self.by_client.items()))
+        rejections = ','.join('{0}:{1}'.format(limit, count) for limit, count in sorted(self.rejections.items()))
+
+        self.logger.info('slots jobs={0}/{1} {2} clients={3} rejections={4}'.format(
+            len(self.holders), self.max_jobs or '-', actions, clients or '-', rejections or '-'))
@@ -0,0 +1,133 @@
+import os
+import stat
+import hashlib
+import tempfile
+import subprocess
+
+from lib.config import ConfigManager
+
+
+class SshConnectionPool():
+    """
+    Keeps one multiplexed (ControlMaster) ssh connection open per remote client
+    Every ssh command and rsync transport to that client then reuses the master instead of
+    doing its own TCP and SSH handshake
+    The masters are started from the forked jobs, so the control sockets on disk are the only record of them
+    that the daemon can see. ssh closes a master itself once it has been idle for idle_timeout (ControlPersist)
+    """
+
+    # ssh -O wants a destination, it goes by the ControlPath we give it instead so any name will do
+    CONTROL_DESTINATION = 'jqm-ssh-master'
+
+    def __init__(self, ssh_config=None, logger=None):
+        """ Setup where the control sockets live and how long an idle master is kept """
+        if ssh_config is None:
+            ssh_config = ConfigManager.default_section(ConfigManager.SSH)
+
+        self.logger = logger
+        self.enabled = ConfigManager.as_bool(ssh_config.connection_pool)
+        self.idle_timeout = int(ssh_config.idle_timeout)
+
+        # Unix socket paths are limited to ~100 chars and rsync splits --rsh on whitespace, keep it short and simple
+        self.control_dir = ssh_config.control_dir or os.path.join(tempfile.gettempdir(),
+                                                                  'jqm-ssh-{0}'.format(os.getuid()))
+        # Whether the control directory is ours alone, checked on first use
+        self.trusted = None
+
+        # Counted by each process (job) using the pool
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def client_key(client):
+        """ The pool is keyed on where we connect to and who as """
+        return client['host_hostname'], client['host_port'], client['host_username']
+
+    def control_path(self, key):
+        """ Returns the control socket path for the given pool key """
+        name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.control_dir, name)
+
+    def trusted_control_dir(self):
+        """
+        Creates the control directory, returns whether the sockets can be kept in it
+        It has to be a directory (not a symlink) of our own that only we can get into, or another user could plant
+        sockets in it and have our commands and transfers go through their master connections
+        """
+        if self.trusted is None:
+            try:
+                os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+                info = os.lstat(self.control_dir)
+                self.trusted = stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid()
+                if self.trusted:
+                    os.chmod(self.control_dir, 0o700)
+            except OSError as e:
+                self.trusted = False
+                if self.logger:
+                    self.logger.error('Unable to setup ssh control directory {0} ({1})'.format(self.control_dir, e))
+
+            if not self.trusted and self.logger:
+                self.logger.error('Not pooling ssh connections, {0} is not a directory of our own'.format(
+                    self.control_dir))
+
+        return self.trusted
+
+    def ssh_options(self, client):
+        """
+        Returns the ssh options that route a connection to the client through its master connection
+        The master is started by ssh itself on first use (ControlMaster=auto) and stays up until idle
+        """
+        if not self.enabled or not self.trusted_control_dir():
+            return list()
+
+        key = self.client_key(client)
+        control_path = self.control_path(key)
+
+        # A live socket means a master is already up, possibly started by another job's process
+        if os.path.exists(control_path):
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        return ['-o', 'ControlMaster=auto',
+                '-o', 'ControlPath={0}'.format(control_path),
+                '-o', 'ControlPersist={0}'.format(self.idle_timeout)]
+
+    def control_paths(self):
+        """ Returns the paths of the control sockets of the masters that are up, whichever job started them """
+        if not self.enabled or not self.trusted_control_dir():
+            return list()
+
+        try:
+            names = os.listdir(self.control_dir)
+        except OSError:
+            return list()
+
+        control_paths = list()
+        for name in names:
+            path = os.path.join(self.control_dir, name)
+            try:
+                if stat.S_ISSOCK(os.stat(path).st_mode):
+                    control_paths.append(path)
+            except OSError:
+                continue
+
+        return control_paths
+
+    def close(self, control_path):
+        """ Ask the master connection listening on the control socket to exit """
+        command = ['ssh', '-O', 'exit', '-o', 'ControlPath={0}'.format(control_path), self.CONTROL_DESTINATION]
+        try:
+            subprocess.check_output(command, stderr=subprocess.STDOUT, universal_newlines=True)
+        except (subprocess.CalledProcessError, OSError) as e:
+            if self.logger:
+                self.logger.warning('Unable to close ssh master {0} ({1})'.format(control_path, e))
+
+    def close_all(self):
+        """ Close every master connection that is up """
+        for control_path in self.control_paths():
+            self.close(control_path)
+
+    def stats(self):
+        """ Returns the hit/miss counts of this process and the number of masters up """
+        return {'hits': self.hits, 'misses': self.misses, 'connections': len(self.control_paths())}
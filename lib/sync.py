@@ -1,6 +1,32 @@
 import os
+import re
+import time
+import json
+import codecs
+import tempfile
+import contextlib
+import shlex
+import signal
+import inspect
+import itertools
+import threading
+import contextvars
 import subprocess
 import multiprocessing
+import concurrent.futures
+
+from lib import helper
+from lib import metrics
+from lib.cache import HashCache
+from lib.logger import CommandLine
+from lib.hashing import HashingEngine
+from lib.bandwidth import BandwidthGovernor
+from lib.journal import CheckpointJournal
+from lib.progress import ProgressTracker, RsyncProgressParser
+from lib.config import ConfigManager
+from lib.slots import SlotScheduler
+from lib.engine import build_engine
+from lib.compression import CompressionPolicy
 
 
 class SyncManager():
@@ -25,29 +51,208 @@ class SyncManager():
     REMOTE_PROG_HASH = 'sha256sum'
     REMOTE_PROG_LS = 'ls'
     REMOTE_PROG_RM = 'rm'
+    REMOTE_PROG_PYTHON = 'python3'
 
-    def __init__(self, api_manager, logger):
+    HELPER_ACTION_VERIFY = 'verify'
+    HELPER_ACTION_MANIFEST = 'manifest'
+    HELPER_ACTION_DELETE = 'delete'
+
+    TRANSFER_MODE_FILE = 'file'
+    TRANSFER_MODE_PACKAGE = 'package'
+
+    # Exit codes where rsync (may have) sent some of the files
+    RSYNC_PARTIAL_CODES = (0, 23, 24)
+    # An itemized regular file (YXcstpoguax), eg. '>f+++++++++ foo/file_12.avro' or '.f          file_9.gz'
+    RSYNC_ITEMIZED_FILE = re.compile(r'^[<>ch.]f.{9} (.+)$')
+
+    def __init__(self, api_manager, logger, sync_config=None, ssh_pool=None, compression_policy=None,
+                 slot_scheduler=None, hashing_engine=None, bandwidth_governor=None):
         """ Setup the API interactions and logger """
 
         self.api_manager = api_manager
         self.logger = logger
+        self.ssh_pool = ssh_pool
+        self.compression_policy = compression_policy or CompressionPolicy(logger=logger)
         self.job_queue = list()
         self.processing_queue = list()
+        self.processing_job_ids = dict()
+        # process -> the id of the job it runs, so a finished process leads straight to its job
+        self.processing_jobs = dict()
+
+        # Caps the jobs running at once, in total, per action and per destination client
+        self.slots = slot_scheduler or SlotScheduler(logger=logger)
+
+        # Shares the clients' bandwidth between the transfers running to/from them across every job
+        self.governor = bandwidth_governor or BandwidthGovernor(logger=logger)
+
+        if sync_config is None:
+            sync_config = ConfigManager.default_section(ConfigManager.SYNC)
+
+        self.batch_verify = ConfigManager.as_bool(sync_config.batch_verify)
+        # Diffing the manifests of both sides relies on the helper as well
+        self.manifest_sync = ConfigManager.as_bool(sync_config.manifest_sync)
+        self.helper_source = inspect.getsource(helper)
+        self.hashing_engine = hashing_engine or HashingEngine()
+
+        # Clients we couldn't run the helper on, they get verified file by file
+        self.helper_unavailable = set()
+
+        self.hash_cache = HashCache(int(sync_config.hash_cache_size), path=sync_config.hash_cache_file or None)
+
+        # Per file progress of the jobs, and where rsync keeps partially sent files, so jobs resume after a restart
+        self.journal = CheckpointJournal(sync_config.checkpoint_file or None)
+        self.partial_dir = sync_config.partial_dir
+
+        # Most often a SYNC's progress is sent to the API, in seconds
+        self.progress_interval = float(sync_config.progress_interval)
+
+        # Packages are worked through this many files at a time, keeping a job's memory use bounded
+        self.chunk_size = int(sync_config.chunk_size)
+
+        # Parallel rsync streams within a job, and across all jobs to the same destination client
+        self.transfer_mode = sync_config.transfer_mode
+        self.transfer_concurrency = int(sync_config.transfer_concurrency)
+        self.max_streams_per_client = int(sync_config.max_streams_per_client)
+
+        # Destination client id -> semaphore, created before the jobs fork so they all share it
+        self.client_streams = dict()
+
+        # What runs the jobs (a forked process or a thread each) and their commands and job updates
+        self.engine = build_engine(self, sync_config.engine)
 
     class AlreadyWorkingOnException(Exception):
         """ The job we have been given is already being worked on """
         pass
 
-    class ActionAlreadyWorkingOnException(Exception):
-        """ The job action is already being worked on """
-        pass
-
     @staticmethod
     def shell_out(command):
         """ Generic method to shell out to the OS """
         process = subprocess.check_output(command, stderr=subprocess.PIPE, universal_newlines=True)
         return process
 
+    @staticmethod
+    def stream_out(command, lines):
+        """
+        Shell out to the OS feeding the given lines to stdin, yields each line of stdout as it arrives
+        Raises CalledProcessError once the output is exhausted if the command failed
+        Closed before then (the caller gave up on a bad response) the command is killed, it's always waited on
+        """
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   universal_newlines=True)
+
+        def feed_stdin():
+            """ Written from a thread so a full stdout pipe can't deadlock us against the command """
+            try:
+                for line in lines:
+                    process.stdin.write(line + '\n')
+            except BrokenPipeError:
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        stderr = list()
+        feeder = threading.Thread(target=feed_stdin, daemon=True)
+        drainer = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+        feeder.start()
+        drainer.start()
+
+        exhausted = False
+        try:
+            for line in process.stdout:
+                yield line
+            exhausted = True
+        finally:
+            if not exhausted:
+                process.kill()
+
+            feeder.join()
+            drainer.join()
+            process.stdout.close()
+            process.stderr.close()
+            process.wait()
+
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command, stderr=''.join(stderr))
+
+    @staticmethod
+    def parse_out(command, parser, lease=None):
+        """
+        Shell out to the OS feeding stdout to the parser as it arrives, rsync's progress being carriage return
+        (not newline) separated
+        Given a bandwidth Lease, the command is paused (SIGSTOP) whenever it has sent more than its share
+        Returns (returncode, the output the parser kept, stderr)
+        """
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        stderr = list()
+        drainer = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+        drainer.start()
+
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        while True:
+            data = os.read(process.stdout.fileno(), 65536)
+            if not data:
+                break
+            parser.feed(decoder.decode(data))
+
+            pause = lease.consume(parser.take()) if lease else 0
+            if pause and process.poll() is None:
+                process.send_signal(signal.SIGSTOP)
+                try:
+                    time.sleep(pause)
+                finally:
+                    process.send_signal(signal.SIGCONT)
+        parser.feed(decoder.decode(b'', final=True))
+
+        drainer.join()
+        process.stdout.close()
+        process.stderr.close()
+
+        return process.wait(), parser.close(), b''.join(stderr).decode('utf-8', 'replace')
+
+    @staticmethod
+    def is_local(client):
+        """ The API blanks out the host details of the client we are running on """
+        return not client['host_hostname']
+
+    def ssh_transport(self, client):
+        """ Returns the ssh command (minus the destination) used to reach the remote client """
+        command = ['ssh']
+
+        if client['host_port']:
+            command.extend(['-p', str(client['host_port'])])
+
+        if self.ssh_pool:
+            command.extend(self.ssh_pool.ssh_options(client))
+
+        return command
+
+    def build_command(self, client, cmd):
+        """
+        Returns the command that runs cmd on the client, wrapped in ssh when the client is remote
+        Assumes SSH Keys are setup and password-less auth works
+        """
+        # Test if the client is local, if so run the command as is
+        if self.is_local(client):
+            self.logger.debug("Client is local, just shelling out without ssh")
+            return list(cmd)
+
+        # Client is remote, build the SSH command
+        command = self.ssh_transport(client)
+
+        if client['host_username']:
+            command.append(client['host_username'] + '@' + client['host_hostname'])
+        else:
+            command.append(client['host_hostname'])
+
+        # The remote shell re-parses the command, quote it so paths with spaces survive the trip
+        command.extend(shlex.quote(arg) for arg in cmd)
+
+        return command
+
     def ssh_command(self, client, cmd):
         """
         Executes an SSH command to the remote host and returns the SSH output
@@ -58,63 +263,105 @@ class SyncManager():
             self.logger.error("Command given must be iterable")
             return self.SSH_FAILED
 
-        # Test if the client is local, if so shell out without building the ssh part
-        if not client['host_hostname'] and not client['host_port'] and not client['host_username']:
-            self.logger.debug("Client is local, just shelling out without ssh")
-            self.logger.debug("LOCAL COMMAND: {0}".format(" ".join(cmd)))
-            return self.shell_out(cmd)
+        command = self.build_command(client, cmd)
 
-        # Client is remote, build the SSH command
-        command = ['ssh']
+        self.logger.debug('SSH COMMAND: %s', CommandLine(command))
+        with metrics.registry.timer('jqm_ssh_command_seconds', client=client['name'], command=cmd[0]):
+            return self.engine.shell_out(command)
 
-        if client['host_port']:
-            command.append('-p {0}'.format(client['host_port']))
+    def use_helper(self, client):
+        """ Whether to go through the helper on the client, it's always run in process for a local client """
+        return self.batch_verify or self.is_local(client)
 
-        if client['host_username']:
-            command.append(client['host_username'] + '@' + client['host_hostname'])
-        else:
-            command.append(client['host_hostname'])
+    @staticmethod
+    def client_key(client):
+        """ Returns the key of where we connect to the client and who as """
+        return client['host_hostname'], client['host_port'], client['host_username']
 
-        command.extend(cmd)
+    def helper_available(self, client):
+        """ Whether the client's files can be gone through in one helper run, as far as we know """
+        return self.use_helper(client) and self.client_key(client) not in self.helper_unavailable
 
-        self.logger.debug("SSH COMMAND: {0}".format(' '.join(command)))
-        return self.shell_out(command)
+    def local_helper(self, action, requests):
+        """ Runs the helper action over the requests in this process, returns the list() of responses """
+        # Verifying is the one that needs hashing, it's spread over all the cores
+        if action == self.HELPER_ACTION_VERIFY:
+            return self.hashing_engine.verify(requests)
 
-    def rsync_file(self, src_client, dst_client, package_file):
+        return [helper.ACTIONS[action](request) for request in requests]
+
+    def helper_command(self, client, action, requests):
         """
-        Supports sending a file from a [local|remote] host
-        to its respective [remote|local] destination
-        This assumes that [src|dst]_file is the fully qualified file path
+        Runs the helper action over all the requests on the client in a single invocation
+        Yields the helper's response to each request, in the same order as the requests
+        A local client needs no helper process, the action is run in this process instead
+        """
+        if self.is_local(client):
+            yield from self.local_helper(action, requests)
+            return
+
+        command = self.build_command(client, [self.REMOTE_PROG_PYTHON, '-c', self.helper_source, action])
+
+        self.logger.debug('HELPER COMMAND: %s on client %s', action, client['name'])
+        lines = self.engine.stream_out(command, (json.dumps(request) for request in requests))
+        with metrics.registry.timer('jqm_ssh_command_seconds', client=client['name'], command='helper_' + action):
+            try:
+                for line in lines:
+                    yield json.loads(line)
+            finally:
+                lines.close()
+
+    @staticmethod
+    def helper_responses(package_files, requests, responses):
+        """
+        Yields (package_file, request, response) of each file, reading the helper's output through to the end
+        afterwards so it's waited on (and raises CalledProcessError if it failed) rather than killed
+        Raises ValueError if the helper doesn't give exactly one response per request
+        """
+        count = 0
+        for package_file, request in zip(package_files, requests):
+            response = next(responses, None)
+            if response is None:
+                raise ValueError('Helper gave {0} responses for {1} files'.format(count, len(requests)))
+            count += 1
+            yield package_file, request, response
+
+        if next(responses, None) is not None:
+            raise ValueError('Helper gave more responses than the {0} files asked about'.format(len(requests)))
+
+    def rsync_command(self, src_client, dst_client, compression):
+        """
+        Returns the base rsync command (options, compression, transport, bwlimit) for sending between the clients
+        Returns None if rsync can't send between the two clients
         """
 
         # Check that we don't have both as a 'remote' client
-        if 'host_hostname' in src_client and 'host_hostname' in dst_client:
+        if not self.is_local(src_client) and not self.is_local(dst_client):
             self.logger.error('Cannot have both as remote hosts')
-            return self.RSYNC_FAILED
-
-        # Check to ensure at least one client is 'remote'
-        if 'host_hostname' not in src_client and 'host_hostname' not in dst_client:
-            self.logger.error('At least one client needs to be a remote client')
-            return self.RSYNC_FAILED
+            return None
 
         # Report if we are defaulting to the default user
-        if ('host_hostname' in src_client and 'host_username' not in src_client) \
-                or ('host_hostname' in dst_client and 'host_username' not in dst_client):
+        if (not self.is_local(src_client) and not src_client['host_username']) \
+                or (not self.is_local(dst_client) and not dst_client['host_username']):
             self.logger.debug("rsync user defaulting to the username '{0}'".format(os.getlogin()))
 
         # Build the rsync command
         command = ['rsync']
 
-        # Turn this into a variable maybe?
-        command.extend(['--progress', '--verbose', '--compress'])
+        command.extend(['--progress', '--verbose'])
 
-        # Extend the rsync command with the port of the remote user
-        if src_client['host_hostname'] and src_client['host_port']:
-            command.append('--rsh=ssh -p {0}'.format(src_client['host_port']))
-        elif dst_client['host_hostname'] and dst_client['host_port']:
-            command.append('--rsh=ssh -p {0}'.format(dst_client['host_port']))
-        else:
-            self.logger.debug('Assuming port for 22 for rsync call')
+        # Keep what made it of an interrupted file so the next attempt sends only the rest
+        if self.partial_dir:
+            command.append('--partial-dir={0}'.format(self.partial_dir))
+        command.extend(self.compression_policy.rsync_options(compression))
+
+        # Extend the rsync command with the ssh transport (port and pooled master connection) of the remote client
+        # Both clients being local (two disks of this host) rsync copies between them directly
+        if not self.is_local(src_client) or not self.is_local(dst_client):
+            remote_client = dst_client if self.is_local(src_client) else src_client
+            if not remote_client['host_port']:
+                self.logger.debug('Assuming port for 22 for rsync call')
+            command.append('--rsh={0}'.format(' '.join(self.ssh_transport(remote_client))))
 
         # Extend the rsync command with the bandwidth limit (bwlimit)
         if src_client['max_upload']:
@@ -128,32 +375,120 @@ class SyncManager():
         else:
             max_sync = 0
 
-        # Only append if we have a value > 0
+        # Only append if we have a value > 0, scaled by the time of day
+        max_sync = self.governor.limit(max_sync)
         if max_sync:
             command.append('--bwlimit={0}'.format(max_sync))
 
+        return command
+
+    @staticmethod
+    def rsync_location(client, file_path):
+        """ Takes a client and a file path, returns the [user@][host:]path rsync location """
+        location = ''
+
+        if client['host_username']:
+            location += client['host_username'] + '@'
+
+        if client['host_hostname']:
+            location += client['host_hostname'] + ':'
+
+        location += client['base_path'] + file_path
+
+        return location
+
+    def rsync_file(self, src_client, dst_client, package_file, progress=None):
+        """
+        Supports sending a file from a [local|remote] host
+        to its respective [remote|local] destination
+        This assumes that [src|dst]_file is the fully qualified file path
+        """
+        compression = self.compression_policy.decide(src_client, dst_client, [package_file])
+        command = self.rsync_command(src_client, dst_client, compression)
+        if command is None:
+            return self.RSYNC_FAILED
+
         # We now have the base part of the command done
         # we process the source and then destination parts
-        def build_rsync_location(local_client, file_path):
-            """ Takes a client and a file path """
-            location = ''
+        for client in [src_client, dst_client]:
+            command.append(self.rsync_location(client, package_file['relative_path']))
+
+        self.logger.debug('RSYNC COMMAND: %s', CommandLine(command))
 
-            if local_client['host_username']:
-                location += local_client['host_username'] + '@'
+        started = time.time()
+        parser = RsyncProgressParser(progress, key=package_file['relative_path'])
+        with self.governor.lease(src_client, dst_client) as lease:
+            returncode, output, stderr = self.engine.parse_out(command, parser, lease)
+        self.rsync_metrics(self.TRANSFER_MODE_FILE, started, src_client, dst_client, parser)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, command, output=output, stderr=stderr)
+        self.compression_policy.record(compression, self.file_size(src_client, package_file), started)
 
-            if local_client['host_hostname']:
-                location += local_client['host_hostname'] + ':'
+        return output
 
-            location += local_client['base_path'] + file_path
+    def rsync_package(self, src_client, dst_client, package_files, progress=None):
+        """
+        Sends all the given files with a single rsync rooted at each client's base_path
+        Returns the set() of relative paths rsync itemized as sent or already up to date, None if rsync
+        couldn't be run at all
+        """
+        with tempfile.NamedTemporaryFile('w', prefix='jqm-files-from-', suffix='.txt') as files_from:
+            command, compression = self.rsync_package_command(src_client, dst_client, package_files, files_from)
+            if command is None:
+                return None
+
+            self.logger.debug('RSYNC COMMAND: %s', CommandLine(command))
+            started = time.time()
+            parser = RsyncProgressParser(progress, file_pattern=self.RSYNC_ITEMIZED_FILE)
+            with self.governor.lease(src_client, dst_client) as lease:
+                returncode, output, stderr = self.engine.parse_out(command, parser, lease)
+            self.rsync_metrics(self.TRANSFER_MODE_PACKAGE, started, src_client, dst_client, parser)
+            self.compression_policy.record(compression, sum(self.file_size(src_client, package_file)
+                                                            for package_file in package_files), started)
+
+        # 23/24 are partial transfers, the itemized output tells us which files made it
+        if returncode not in self.RSYNC_PARTIAL_CODES:
+            self.logger.error('Rsync of package failed ({0}): {1}'.format(returncode, stderr.strip()))
+
+        return self.rsync_transferred(output)
 
-            return location
+    @staticmethod
+    def rsync_metrics(mode, started, src_client, dst_client, parser):
+        """ Record how long the rsync (started at started) ran for and the bytes it sent """
+        metrics.registry.observe('jqm_rsync_seconds', time.time() - started, mode=mode)
+        metrics.registry.inc('jqm_transferred_bytes_total', parser.total_sent, source=src_client['name'],
+                             destination=dst_client['name'])
 
-        for client in [src_client, dst_client]:
-            command.append(build_rsync_location(client, package_file['relative_path']))
+    def rsync_package_command(self, src_client, dst_client, package_files, files_from):
+        """
+        Writes the relative paths of the files into the (open) files_from list
+        Returns (command, compression decision) of the rsync that sends them, command being None if it can't
+        """
+        compression = self.compression_policy.decide(src_client, dst_client, package_files)
+        command = self.rsync_command(src_client, dst_client, compression)
+        if command is None:
+            return None, compression
+
+        for package_file in package_files:
+            files_from.write(package_file['relative_path'].lstrip('/') + '\n')
+        files_from.flush()
+
+        # Itemizing twice also lists the files that were already up to date
+        command.extend(['--files-from={0}'.format(files_from.name), '--itemize-changes', '--itemize-changes'])
+        command.extend([self.rsync_location(src_client, ''), self.rsync_location(dst_client, '')])
 
-        self.logger.debug('RSYNC COMMAND: {0}'.format(' '.join(command)))
+        return command, compression
 
-        return self.shell_out(command)
+    def rsync_transferred(self, output):
+        """ Returns the set() of relative paths in rsync's itemized output """
+        transferred = set()
+
+        for line in output.splitlines():
+            match = self.RSYNC_ITEMIZED_FILE.match(line)
+            if match:
+                transferred.add(match.group(1))
+
+        return transferred
 
     def handle_packages(self, job_id, packages, src_client, dst_client, action):
         """ Wrapper around handle_package allowing multiple packages to be worked on """
@@ -168,85 +503,489 @@ class SyncManager():
 
     def handle_package(self, job_id, package, src_client, dst_client, action):
         """ Transfers a package between clients (or deletes/etc depending on action) """
-        self.logger.debug("{0}'ing package {1} from {2} to {3}".format(action, package['name'], src_client['name'],
-                                                                       dst_client['name']))
-        self.api_manager.update_job_state(job_id, 'PROG')
-        outcome = None
+        self.logger.debug("%s'ing package %s from %s to %s", action, package['name'], src_client['name'],
+                          dst_client['name'])
+        self.engine.update_job_state(job_id, 'PROG')
+        self.resume(job_id)
+        outcome = self.PACKAGE_ACTION_WORKED
+        chunked = False
+        progress = self.progress_tracker(job_id, src_client, package) if action == 'SYNC' else None
+
+        if action == 'DEL':
+            # All of the package has to be there before any of it is deleted
+            verified = None
+            for chunk in self.package_chunks(package):
+                chunked = chunked or chunk.get('chunk', False)
+                if self.verify_package(dst_client, chunk) != self.VERIFICATION_FULL:
+                    self.logger.error('Destination package is not complete, skipping')
+                    outcome = self.PACKAGE_ACTION_FAILED
+                    break
+                verified = chunk
+
+            if outcome == self.PACKAGE_ACTION_WORKED:
+                self.logger.debug('Destination package is in a good condition to delete')
+                # A package that fit in one chunk is still in hand, only a chunked one is paged in again
+                chunks = self.package_chunks(package) if chunked or verified is None else [verified]
+                for chunk in chunks:
+                    if self.delete_package(dst_client, chunk) != self.PACKAGE_ACTION_WORKED:
+                        outcome = self.PACKAGE_ACTION_FAILED
+
+        elif action in ('SYNC', 'INDEX'):
+            for chunk in self.package_chunks(package):
+                chunked = chunked or chunk.get('chunk', False)
+                result = self.handle_chunk(job_id, chunk, src_client, dst_client, action, progress)
+                if result != self.PACKAGE_ACTION_WORKED:
+                    outcome = self.PACKAGE_ACTION_FAILED
+                    # The rest of an INDEX still gets reported, there's no point sending more of a broken SYNC
+                    if action == 'SYNC':
+                        break
+
+        else:
+            outcome = None
+
+        # Deleting only reports the files, so the package is reported after a DEL whether it was chunked or not
+        if chunked or action == 'DEL':
+            self.associate_package(dst_client, package, action, outcome)
+
+        if progress:
+            progress.report(force=True)
+
+        self.wrap_up(job_id)
+        self.job_metrics(action, outcome)
 
+        if outcome == self.PACKAGE_ACTION_WORKED:
+            return self.engine.update_job_state(job_id, 'COMP')
+        else:
+            return self.engine.update_job_state(job_id, 'FAIL')
+
+    def job_metrics(self, action, outcome):
+        """ Count the job as finished or failed """
+        if outcome == self.PACKAGE_ACTION_WORKED:
+            metrics.registry.inc('jqm_jobs_finished_total', action=action)
+        else:
+            metrics.registry.inc('jqm_jobs_failed_total', action=action)
+
+    def handle_chunk(self, job_id, package, src_client, dst_client, action, progress=None):
+        """ SYNC or INDEX the package (chunk), returns the outcome """
         if action == 'SYNC':
-            if self.verify_package(src_client, package) == self.VERIFICATION_FULL:
-                if self.verify_package(dst_client, package) != self.VERIFICATION_FULL:
-                    outcome = self.transfer_package(src_client, dst_client, package)
-                else:
-                    self.logger.error('Destination package exists already, returning that it worked')
-                    outcome = self.PACKAGE_ACTION_WORKED
+            outcome = None
+            if self.manifest_sync:
+                outcome = self.sync_package(src_client, dst_client, package, job_id, progress)
+
+            # Without manifests (no helper on a client) every file is verified on both sides
+            if outcome is None:
+                outcome = self.verify_and_transfer_package(src_client, dst_client, package, job_id, progress)
+
+            return outcome
+
+        if self.verify_package(dst_client, package) == self.VERIFICATION_FULL:
+            return self.PACKAGE_ACTION_WORKED
+        else:
+            return self.PACKAGE_ACTION_FAILED
+
+    def package_chunks(self, package):
+        """
+        Yields the package with its files split into chunks of up to chunk_size files, the files being read
+        as a stream so only a chunk or two is ever held in memory
+        A package that fits in one chunk is yielded whole, otherwise each chunk is marked as being one
+        """
+        package_files = iter(package['package_files'])
+        chunk = list(itertools.islice(package_files, self.chunk_size))
+        following = list(itertools.islice(package_files, self.chunk_size))
+
+        if not following:
+            yield dict(package, package_files=chunk)
+            return
+
+        while chunk:
+            yield dict(package, package_files=chunk, chunk=True)
+            chunk, following = following, list(itertools.islice(package_files, self.chunk_size))
+
+    def progress_tracker(self, job_id, src_client, package):
+        """
+        Returns the ProgressTracker of a SYNC of the package, sending its progress to the API through the engine
+        The size the scheduler noted on the package saves reading its files through once more
+        """
+        total = package.get('package_size')
+        if not total:
+            total = sum(self.file_size(src_client, package_file) for package_file in package['package_files'])
+        return ProgressTracker(job_id, total, self.engine.update_job_progress, self.progress_interval,
+                               logger=self.logger)
+
+    def skipped(self, progress, src_client, package_files):
+        """ The files are already on the destination, so count them as done """
+        if progress:
+            progress.skip(sum(self.file_size(src_client, package_file) for package_file in package_files))
+
+    def associate_package(self, client, package, action, outcome):
+        """ Report the availability of a package deleted or worked through in chunks, neither reports it """
+        available = action != 'DEL' and outcome == self.PACKAGE_ACTION_WORKED
+        self.api_manager.associate_client_with_package(client['id'], package['id'], available)
+
+    def verify_and_transfer_package(self, src_client, dst_client, package, job_id=None, progress=None):
+        """ Verify the whole package on both sides, sending it across if the destination doesn't have it all """
+        if self.verify_package(src_client, package, job_id, self.journal.VERIFIED) == self.VERIFICATION_FULL:
+            if self.verify_package(dst_client, package, job_id, self.journal.CONFIRMED) != self.VERIFICATION_FULL:
+                return self.transfer_package(src_client, dst_client, package, job_id, progress)
             else:
+                self.logger.error('Destination package exists already, returning that it worked')
+                self.skipped(progress, src_client, package['package_files'])
+                return self.PACKAGE_ACTION_WORKED
+        else:
+            self.logger.error('Source package is incomplete or corrupt, bailing')
+            return self.PACKAGE_ACTION_FAILED
+
+    def sync_package(self, src_client, dst_client, package, job_id=None, progress=None):
+        """
+        Takes a manifest (stat + any still valid cached hash) of the package on each side in one pass each,
+        diffs them and only verifies and sends the files that differ
+        Returns None if a manifest couldn't be taken
+        """
+        dst_results = self.checkpointed(dst_client, package, job_id, self.journal.CONFIRMED)
+        package_files = [package_file for package_file in package['package_files']
+                         if package_file['id'] not in dst_results]
+
+        src_manifest = self.manifest(src_client, package_files)
+        dst_manifest = self.manifest(dst_client, package_files) if src_manifest is not None else None
+        if dst_manifest is None:
+            return None
+
+        in_sync, unsure, changed = self.diff_manifests(package_files, src_manifest, dst_manifest)
+
+        # Same size on both sides but no hash we can trust, only hashing the destination's copy will tell
+        if unsure:
+            results = self.verify_files(dst_client, unsure)
+            in_sync.extend(package_file for package_file in unsure
+                           if results.get(package_file['id']) == self.VERIFICATION_FULL)
+            changed.extend(package_file for package_file in unsure
+                           if results.get(package_file['id']) != self.VERIFICATION_FULL)
+
+        self.log_diff(package, in_sync, unsure, changed)
+        self.skipped(progress, src_client, in_sync)
+        dst_results.update((package_file['id'], self.VERIFICATION_FULL) for package_file in in_sync)
+
+        if changed:
+            # Only the source files we are about to send need to be verified
+            src_results = self.checkpointed(src_client, {'package_files': changed}, job_id, self.journal.VERIFIED)
+            unverified = [package_file for package_file in changed if package_file['id'] not in src_results]
+            src_results.update(self.verify_all(src_client, unverified))
+            self.checkpoint(src_client, unverified, src_results, job_id, self.journal.VERIFIED)
+
+            if any(src_results[package_file['id']] != self.VERIFICATION_FULL for package_file in changed):
                 self.logger.error('Source package is incomplete or corrupt, bailing')
-                outcome = self.PACKAGE_ACTION_FAILED
+                return self.PACKAGE_ACTION_FAILED
 
-        elif action == 'DEL':
-            if self.verify_package(dst_client, package) == self.VERIFICATION_FULL:
-                self.logger.debug('Destination package is in a good condition to delete')
-                outcome = self.delete_package(dst_client, package)
-            else:
-                self.logger.error('Destination package is not complete, skipping')
-                outcome = self.PACKAGE_ACTION_FAILED
+            package_files = changed
+            if self.transfer_mode == self.TRANSFER_MODE_PACKAGE:
+                package_files = self.transfer_files_at_once(src_client, dst_client, package_files, missing=True,
+                                                            progress=progress)
 
-        elif action == 'INDEX':
-            outcome = self.verify_package(dst_client, package)
+            bad_transfers = self.transfer_files(src_client, dst_client, package_files, progress)
+            self.journal.record(job_id, dst_client, [package_file['id'] for package_file in changed
+                                                     if package_file['id'] not in bad_transfers],
+                                self.journal.TRANSFERRED)
 
-        if outcome == self.PACKAGE_ACTION_WORKED:
-            return self.api_manager.update_job_state(job_id, 'COMP')
+            # Only what we sent needs verifying again
+            dst_results.update(self.verify_all(dst_client, changed))
+
+        self.checkpoint(dst_client, in_sync + changed, dst_results, job_id, self.journal.CONFIRMED)
+
+        if self.report_verification(dst_client, package, dst_results) == self.VERIFICATION_FULL:
+            self.logger.info('Sync of package worked')
+            return self.PACKAGE_ACTION_WORKED
         else:
-            return self.api_manager.update_job_state(job_id, 'FAIL')
+            self.logger.error('Sync of package failed, failed file_id\'s were: ' + ' '.join(
+                str(package_file['id']) for package_file in changed
+                if dst_results[package_file['id']] != self.VERIFICATION_FULL))
+            return self.PACKAGE_ACTION_FAILED
+
+    def manifest(self, client, package_files):
+        """
+        Stats all the given files with a single helper invocation on the client, without reading them
+        Returns a dict() of package_file id -> manifest entry, None if the helper couldn't be run
+        """
+        if not self.helper_available(client):
+            return None
+
+        package_files = list(package_files)
+        requests = self.verification_requests(client, package_files)
+
+        responses = self.helper_command(client, self.HELPER_ACTION_MANIFEST, requests)
+        try:
+            return self.manifest_entries(package_files, requests, responses)
+        except (subprocess.CalledProcessError, OSError, ValueError) as e:
+            self.logger.error('Manifest failed on client {0} ({1})'.format(client['name'], e))
+            self.helper_unavailable.add(self.client_key(client))
+            return None
+        finally:
+            responses.close()
+
+    @staticmethod
+    def manifest_entries(package_files, requests, responses):
+        """ Returns a dict() of package_file id -> the helper's manifest entry of the file """
+        entries = dict()
+        for package_file, request, response in SyncManager.helper_responses(package_files, requests, responses):
+            if response['path'] != request['path']:
+                raise ValueError('Helper responded for {0} when asked for {1}'.format(response['path'],
+                                                                                       request['path']))
+            entries[package_file['id']] = response
+
+        return entries
+
+    @staticmethod
+    def diff_manifests(package_files, src_manifest, dst_manifest):
+        """
+        Returns (in_sync, unsure, changed) lists of the files
+        in_sync the destination has (going by its cached hash), unsure need hashing on the destination to tell,
+        changed need sending (missing, a different size or a known different hash)
+        """
+        in_sync, unsure, changed = list(), list(), list()
+
+        for package_file in package_files:
+            src = src_manifest[package_file['id']]
+            dst = dst_manifest[package_file['id']]
+
+            if not dst['exists'] or (src['exists'] and src['size'] != dst['size']):
+                changed.append(package_file)
+            elif 'hash' in dst:
+                (in_sync if dst['hash'] == package_file['file_hash'] else changed).append(package_file)
+            else:
+                unsure.append(package_file)
+
+        return in_sync, unsure, changed
+
+    def log_diff(self, package, in_sync, unsure, changed):
+        """ Report on the manifest diff of the package """
+        self.logger.info('Manifest diff of package {0}: {1} files in sync, {2} to send, {3} had to be hashed to tell'
+                         .format(package['name'], len(in_sync), len(changed), len(unsure)))
+
+    def wrap_up(self, job_id):
+        """ Report on the job's connection stats and save what it learnt for the next job """
+        if self.ssh_pool:
+            self.logger.debug('SSH pool stats for job {0}: {1}'.format(job_id, self.ssh_pool.stats()))
+
+        self.logger.debug('API latency for job {0}: {1}'.format(job_id, self.api_manager.latency_stats()))
+
+        # Hand what we learnt about the availability objects and file hashes on to the next job
+        self.api_manager.availability_cache.save()
+        self.hash_cache.save()
+
+        # The job is over (one way or another) so there's nothing to resume
+        self.journal.finish(job_id)
+
+    def resume(self, job_id):
+        """ Report on how far the job got before it was last interrupted """
+        progress = self.journal.progress(job_id)
+        if progress:
+            self.logger.info('Resuming job {0} from its checkpoint ({1})'.format(
+                job_id, ', '.join('{0} {1}'.format(count, state) for state, count in sorted(progress.items()))))
 
-    def transfer_package(self, src_client, dst_client, file_package):
-        """ Wrapper around transfer_file """
-        bad_transfers = []
+    def transfer_package(self, src_client, dst_client, file_package, job_id=None, progress=None):
+        """
+        In package mode all the missing files are sent in one rsync, anything that didn't make it
+        is then retried file by file (as is every file in file mode)
+        Files the job already confirmed on the destination (before being interrupted) aren't sent again
+        """
+        confirmed = self.journal.files(job_id, dst_client, self.journal.CONFIRMED)
+        package_files = [package_file for package_file in file_package['package_files']
+                         if package_file['id'] not in confirmed]
+        to_transfer = list(package_files)
+        self.skipped(progress, src_client, [package_file for package_file in file_package['package_files']
+                                            if package_file['id'] in confirmed])
 
-        for package_file in file_package['package_files']:
-            if self.transfer_file(src_client, dst_client, package_file) != self.PACKAGE_ACTION_WORKED:
-                bad_transfers.append(package_file)
+        if self.transfer_mode == self.TRANSFER_MODE_PACKAGE:
+            package_files = self.transfer_files_at_once(src_client, dst_client, package_files, progress=progress)
 
-        if self.verify_package(dst_client, file_package) == (self.VERIFICATION_FULL, list()):
+        bad_transfers = self.transfer_files(src_client, dst_client, package_files, progress)
+        self.journal.record(job_id, dst_client, [package_file['id'] for package_file in to_transfer
+                                                 if package_file['id'] not in bad_transfers], self.journal.TRANSFERRED)
+
+        if self.verify_package(dst_client, file_package, job_id, self.journal.CONFIRMED) == self.VERIFICATION_FULL:
             self.logger.info('Transfer of package worked')
             return self.PACKAGE_ACTION_WORKED
         else:
             self.logger.error('Transfer of package failed')
-            self.logger.error('Failed file_id\'s were: ' + ' '.join(bad_transfers))
+            self.logger.error('Failed file_id\'s were: ' + ' '.join(str(package_file['id'])
+                                                                     for package_file in bad_transfers.values()))
             return self.PACKAGE_ACTION_FAILED
 
-    def transfer_file(self, src_client, dst_client, package_file):
+    def transfer_files_at_once(self, src_client, dst_client, package_files, missing=False, progress=None):
+        """
+        Sends every file missing off the destination in a single rsync
+        Given missing, the files are already known to be missing (or differ) and aren't checked first
+        Returns the files that still aren't there afterwards
+        Without the helper to verify them in bulk all the files are returned untouched, for the file by file path
+        """
+        if not self.helper_available(dst_client):
+            return list(package_files)
+
+        if missing:
+            missing = list(package_files)
+        else:
+            results = self.verify_files(dst_client, package_files)
+            missing = [package_file for package_file in package_files
+                       if results.get(package_file['id']) != self.VERIFICATION_FULL]
+            self.skipped(progress, src_client, [package_file for package_file in package_files
+                                                if results.get(package_file['id']) == self.VERIFICATION_FULL])
+
+        if not missing:
+            return missing
+
+        with self.client_streams.get(dst_client['id']) or contextlib.nullcontext():
+            try:
+                transferred = self.rsync_package(src_client, dst_client, missing, progress)
+            except OSError as e:
+                self.logger.error('Rsync failed to send the package ({0})'.format(e))
+                transferred = None
+
+        if not transferred:
+            return missing
+
+        # Only the files rsync says it sent are worth checking, the rest go straight to the retry
+        sent = [package_file for package_file in missing if package_file['relative_path'].lstrip('/') in transferred]
+        results = self.verify_files(dst_client, sent)
+
+        failed = [package_file for package_file in missing if results.get(package_file['id']) != self.VERIFICATION_FULL]
+        if failed:
+            self.logger.error('{0} of {1} files did not make it across, retrying them one by one'.format(
+                len(failed), len(missing)))
+
+        return failed
+
+    def transfer_files(self, src_client, dst_client, package_files, progress=None):
+        """
+        Runs transfer_file over the files, up to transfer_concurrency at once
+        The biggest files go first so one doesn't start last and drag out the end of the job
+        Returns a dict() of package_file id -> file that failed to transfer, in the order they were given
+        """
+        bad_transfers = dict()
+
+        order = sorted(range(len(package_files)), key=lambda i: self.file_size(src_client, package_files[i]),
+                       reverse=True)
+
+        def transfer(i):
+            """ Holds one of the destination client's streams for the duration of the transfer """
+            with self.client_streams.get(dst_client['id']) or contextlib.nullcontext():
+                return self.transfer_file(src_client, dst_client, package_files[i], progress)
+
+        # The transfers carry on the job's context, it's how the asyncio engine knows whose commands they are
+        context = contextvars.copy_context()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.transfer_concurrency) as executor:
+            results = dict(zip(order, executor.map(lambda i: context.copy().run(transfer, i), order)))
+
+        for i, package_file in enumerate(package_files):
+            if results[i] != self.PACKAGE_ACTION_WORKED:
+                bad_transfers[package_file['id']] = package_file
+
+        return bad_transfers
+
+    def file_size(self, client, package_file):
+        """ Best guess at the size of the file on the client, from its last verification or the API """
+        known = self.hash_cache.known(client, client['base_path'] + package_file['relative_path'])
+        if known:
+            return known['size']
+
+        return package_file.get('file_size') or 0
+
+    def transfer_file(self, src_client, dst_client, package_file, progress=None):
         """ Takes a file and rsyncs from src->dst (after verifying action needs to be taken) """
         if self.verify_file(dst_client, package_file) == self.VERIFICATION_FULL:
             self.logger.debug('File already exists, skipping transfer')
+            self.skipped(progress, src_client, [package_file])
             return self.PACKAGE_ACTION_WORKED
 
         try:
-            self.rsync_file(src_client, dst_client, package_file)
+            self.rsync_file(src_client, dst_client, package_file, progress)
         except subprocess.CalledProcessError:
             self.logger.error('Rsync failed to send the file properly')
 
         if self.verify_file(dst_client, package_file) == self.VERIFICATION_FULL:
             return self.PACKAGE_ACTION_WORKED
         else:
-            message = 'Failed to transfer file {0} from {1} to {2}'.format(package_file, src_client, dst_client)
-            self.logger.error(message)
+            self.logger.error('Failed to transfer file %s from %s to %s', package_file, src_client, dst_client)
             return self.PACKAGE_ACTION_FAILED
 
     def delete_package(self, client, file_package):
-        """ Takes a single package and deletes it off the client """
+        """
+        Takes a single package and deletes it off the client
+        All the files go in one helper run (pruning the emptied directories), file by file if it can't be run
+        """
+        package_files = list(file_package['package_files'])
+        results = self.delete_files(client, package_files) if self.use_helper(client) else dict()
+
+        for package_file in package_files:
+            if package_file['id'] not in results:
+                results[package_file['id']] = self.delete_file(client, package_file)
+
+        return self.report_deletion(client, file_package, package_files, results)
+
+    def delete_files(self, client, package_files):
+        """
+        Deletes all the given files with a single helper invocation on the client
+        Returns a dict() of package_file id -> PACKAGE_ACTION_WORKED/FAILED, empty if the helper couldn't be run
+        """
+        if not self.helper_available(client):
+            return dict()
+
+        requests = self.deletion_requests(client, package_files)
+        results = dict()
+
+        responses = self.helper_command(client, self.HELPER_ACTION_DELETE, requests)
+        try:
+            for package_file, request, response in self.helper_responses(package_files, requests, responses):
+                results[package_file['id']] = self.deletion_result(client, package_file, request, response)
+        except (subprocess.CalledProcessError, OSError, ValueError) as e:
+            self.logger.error('Batched delete failed on client {0} ({1})'.format(client['name'], e))
+            self.helper_unavailable.add(self.client_key(client))
+        finally:
+            responses.close()
+
+        # Whatever the helper didn't get to is left to delete_file
+        return results
+
+    @staticmethod
+    def deletion_requests(client, package_files):
+        """ Returns the helper delete request for each file, pruning directories up to the client's base_path """
+        return [{'path': client['base_path'] + package_file['relative_path'], 'root': client['base_path']}
+                for package_file in package_files]
+
+    def deletion_result(self, client, package_file, request, response):
+        """ Returns the outcome of the helper's response about deleting the file """
+        if response['path'] != request['path']:
+            raise ValueError('Helper responded for {0} when asked for {1}'.format(response['path'], request['path']))
+
+        self.hash_cache.pop(self.hash_cache.client_key(client, response['path']))
+
+        for directory in response.get('pruned', ()):
+            self.logger.debug('Pruned empty directory %s off client %s', directory, client['name'])
+
+        if response['exists']:
+            self.logger.error('File %s failed to delete off %s (%s)', package_file, client['name'],
+                              response.get('error', 'still there'))
+            return self.PACKAGE_ACTION_FAILED
+
+        return self.PACKAGE_ACTION_WORKED
+
+    def report_deletion(self, client, file_package, package_files, results):
+        """ Reports the deleted files as unavailable, returns the outcome of deleting the package """
+        reporter = self.api_manager.availability_reporter()
         bad_files = list()
 
-        for package_file in file_package['package_files']:
-            if self.delete_file(client, package_file) == self.PACKAGE_ACTION_FAILED:
+        for package_file in package_files:
+            if results[package_file['id']] == self.PACKAGE_ACTION_WORKED:
+                reporter.add(client['id'], package_file['id'], False)
+            else:
                 bad_files.append(package_file)
 
+        reporter.flush()
+
         if bad_files:
-            self.logger.error('Unable to delete file\'s: ' + ' '.join(bad_files))
+            self.logger.error('Unable to delete file\'s: ' + ' '.join(str(package_file['id'])
+                                                                      for package_file in bad_files))
             return self.PACKAGE_ACTION_FAILED
         else:
-            self.logger.debug('Deleted package {0} off client {1}'.format(file_package, client))
+            self.logger.debug('Deleted package %s off client %s', file_package['name'], client['name'])
             return self.PACKAGE_ACTION_WORKED
 
     def delete_file(self, client, package_file):
@@ -263,28 +1002,79 @@ class SyncManager():
             self.logger.error('Something went wrong during the remote rm process')
 
         if self.verify_file(client, package_file) == self.VERIFICATION_FULL:
-            self.logger.error('File package {0} failed to delete off {1}'.format(package_file, client))
+            self.logger.error('File package %s failed to delete off %s', package_file, client)
             return self.PACKAGE_ACTION_FAILED
 
         return self.PACKAGE_ACTION_WORKED
 
-    def verify_package(self, client, package):
+    def verify_package(self, client, package, job_id=None, checkpoint=None):
         """
         Takes a single package and ensures it exists on the given client
         Also updates the API in regards to the outcome
+        Given a checkpoint state, the files the job already checkpointed in it are taken as verified
+        and the files that verify fine are checkpointed in it
         """
+        results = self.checkpointed(client, package, job_id, checkpoint)
+        package_files = [package_file for package_file in package['package_files'] if package_file['id'] not in results]
+
+        results.update(self.verify_all(client, package_files))
+        self.checkpoint(client, package_files, results, job_id, checkpoint)
+
+        return self.report_verification(client, package, results)
+
+    def verify_all(self, client, package_files):
+        """ Returns a dict() of package_file id -> verification result, batched where the helper can be run """
+        if self.use_helper(client):
+            results = self.verify_files(client, package_files)
+        else:
+            results = dict()
+
+        for package_file in package_files:
+            if package_file['id'] not in results:
+                results[package_file['id']] = self.verify_file(client, package_file)
+
+        return results
+
+    def checkpointed(self, client, package, job_id, checkpoint):
+        """ Returns a dict() of package_file id -> VERIFICATION_FULL for the files the job checkpointed """
+        if checkpoint is None:
+            return dict()
 
+        done = self.journal.files(job_id, client, checkpoint)
+        return dict((package_file['id'], self.VERIFICATION_FULL) for package_file in package['package_files']
+                    if package_file['id'] in done)
+
+    def checkpoint(self, client, package_files, results, job_id, checkpoint):
+        """ Checkpoint the files that verified fine """
+        if checkpoint is None:
+            return
+
+        self.journal.record(job_id, client, [package_file['id'] for package_file in package_files
+                                             if results.get(package_file['id']) == self.VERIFICATION_FULL], checkpoint)
+
+    def report_verification(self, client, package, results):
+        """
+        Reports the verification results (package_file id -> result) of the package's files to the API
+        Returns the verification result of the package as a whole
+        """
         bad_files = list()
+        reporter = self.api_manager.availability_reporter()
 
         for package_file in package['package_files']:
-            if self.verify_file(client, package_file) == self.VERIFICATION_FULL:
-                self.api_manager.associate_client_with_file(client['id'], package_file['id'], True)
+            if results[package_file['id']] == self.VERIFICATION_FULL:
+                reporter.add(client['id'], package_file['id'], True)
             else:
-                self.api_manager.associate_client_with_file(client['id'], package_file['id'], False)
+                reporter.add(client['id'], package_file['id'], False)
                 bad_files.append(package_file)
 
+        reporter.flush()
+
+        # A chunk only speaks for its own files, the package is reported once all its chunks are done
+        associate = not package.get('chunk', False)
+
         if bad_files:
-            self.api_manager.associate_client_with_package(client['id'], package['id'], False)
+            if associate:
+                self.api_manager.associate_client_with_package(client['id'], package['id'], False)
             if len(bad_files) > len(package['package_files']):
                 message = 'More bad files ({0}) than files in package ({1})?'.format(len(bad_files),
                                                                                      len(package['package_files']))
@@ -295,8 +1085,70 @@ class SyncManager():
             else:
                 return self.VERIFICATION_PARTIAL
         else:
-            self.api_manager.associate_client_with_package(client['id'], package['id'], True)
+            if associate:
+                self.api_manager.associate_client_with_package(client['id'], package['id'], True)
+            return self.VERIFICATION_FULL
+
+    def verify_files(self, client, package_files):
+        """
+        Verifies all the given files with a single helper invocation on the client
+        Returns a dict() of package_file id -> verification result, empty if the helper couldn't be run
+        """
+        if not self.helper_available(client):
+            return dict()
+
+        package_files = list(package_files)
+        requests = self.verification_requests(client, package_files)
+        results = dict()
+
+        responses = self.helper_command(client, self.HELPER_ACTION_VERIFY, requests)
+        try:
+            for package_file, request, response in self.helper_responses(package_files, requests, responses):
+                results[package_file['id']] = self.verification_result(client, package_file, request, response)
+        except (subprocess.CalledProcessError, OSError, ValueError) as e:
+            # Fall back to verifying each file on its own (older clients may be missing python3)
+            self.logger.error('Batched verification failed on client {0} ({1})'.format(client['name'], e))
+            self.helper_unavailable.add(self.client_key(client))
+            return dict()
+        finally:
+            # Given up on part way through, the helper still has to be killed and waited on
+            responses.close()
+
+        return results
+
+    def verification_requests(self, client, package_files):
+        """
+        Returns the helper verify request for each file
+        Hand the helper the hashes we already know, it only rehashes the files that have changed since
+        """
+        requests = list()
+
+        for package_file in package_files:
+            path = client['base_path'] + package_file['relative_path']
+            requests.append({'path': path, 'known': self.hash_cache.known(client, path)})
+
+        return requests
+
+    def verification_result(self, client, package_file, request, response):
+        """ Returns the verification result of the helper's response about the file """
+        if response['path'] != request['path']:
+            raise ValueError('Helper responded for {0} when asked for {1}'.format(response['path'], request['path']))
+
+        if 'hash' in response:
+            self.hash_cache.store(client, response['path'], response, response['hash'])
+
+        if not response['exists']:
+            self.logger.error('Missing file %s on client %s', package_file, client)
+            return self.VERIFICATION_NONE
+        elif 'hash' not in response:
+            self.logger.error('Unable to perform remote hash for file %s on client %s', package_file, client)
+            return self.VERIFICATION_NONE
+        elif package_file['file_hash'] == response['hash']:
+            self.logger.debug('File hash matches for %s', package_file)
             return self.VERIFICATION_FULL
+        else:
+            self.logger.error('File hash mismatch for file %s on client %s', package_file, client)
+            return self.VERIFICATION_NONE
 
     def verify_file(self, client, package_file):
         """
@@ -305,53 +1157,71 @@ class SyncManager():
         2. Matches the hash
         3. Returns the result
         """
+        # The helper does it in one call and only rehashes the file if it has changed
+        if self.use_helper(client):
+            results = self.verify_files(client, [package_file])
+            if package_file['id'] in results:
+                return results[package_file['id']]
+
         full_path = client['base_path'] + package_file['relative_path']
 
         # Verify the file exists at all
         try:
             self.ssh_command(client, [self.REMOTE_PROG_LS, full_path])
         except subprocess.CalledProcessError:
-            self.logger.error('Missing file {0} on client {1}'.format(package_file, client))
+            self.logger.error('Missing file %s on client %s', package_file, client)
             return self.VERIFICATION_NONE
 
         # Verify the remote hash against the one we have
         try:
             ssh_output = self.ssh_command(client, [self.REMOTE_PROG_HASH, full_path])
         except subprocess.CalledProcessError:
-            self.logger.error('Unable to perform remote hash for file {0} on client {1}'.format(package_file, client))
+            self.logger.error('Unable to perform remote hash for file %s on client %s', package_file, client)
             return self.VERIFICATION_NONE
 
         # $> file_hash file.name.ext
         remote_hash = ssh_output.rstrip().split(' ')[0]
 
         if package_file['file_hash'] == remote_hash:
-            self.logger.debug('File hash matches for {0}'.format(package_file))
+            self.logger.debug('File hash matches for %s', package_file)
             return self.VERIFICATION_FULL
         else:
-            self.logger.error('File hash mismatch for file {0} on client {1}'.format(package_file, client))
+            self.logger.error('File hash mismatch for file %s on client %s', package_file, client)
             return self.VERIFICATION_NONE
 
     def handle(self, job):
         """ Queues the job internally """
-        for process in self.processing_queue:
-            if process.name == job:
-                raise self.AlreadyWorkingOnException
+        if job['id'] in self.processing_job_ids:
+            raise self.AlreadyWorkingOnException
+
+        # Raises SlotScheduler.NoSlotException if the job has to wait for a slot
+        self.slots.acquire(job)
 
-        for process in self.processing_queue:
-            if job['action'] in process.name:
-                raise self.ActionAlreadyWorkingOnException
+        # Forked jobs inherit the semaphore, capping the streams to a client across every job
+        if job['destination_client']['id'] not in self.client_streams:
+            self.client_streams[job['destination_client']['id']] = multiprocessing.BoundedSemaphore(
+                self.max_streams_per_client)
 
-        function_args = (job['id'], job['package'], job['source_client'], job['destination_client'], job['action'])
-        p = multiprocessing.Process(target=self.handle_package, args=function_args, name=job['name'])
-        p.start()
+        # As they do the counts the governor shares the clients' bandwidth out by
+        for client in (job['source_client'], job['destination_client']):
+            self.governor.register(client)
+
+        try:
+            p = self.engine.start(job)
+        except Exception:
+            self.slots.release(job['id'])
+            raise
 
         self.processing_queue.append(p)
+        self.processing_job_ids[job['id']] = p
+        self.processing_jobs[p] = job['id']
+        metrics.registry.inc('jqm_jobs_started_total', action=job['action'])
 
     def complete_jobs(self):
         """ Loop through all the jobs and report back the jobs that we removed """
         removed_processes = list()
 
-        for process in self.processing_queue:
+        for process in list(self.processing_queue):
             if not process.is_alive():
                 # Process outcome will have been reported from within the process itself
                 # Join it to ensure it's finished and remove it from the processing queue
@@ -359,6 +1229,9 @@ class SyncManager():
                 try:
                     process.join(timeout=5)
                     self.processing_queue.remove(process)
+                    job_id = self.processing_jobs.pop(process)
+                    del self.processing_job_ids[job_id]
+                    self.slots.release(job_id)
                     removed_processes.append(process.name)
                 except multiprocessing.TimeoutError as e:
                     self.logger.warn('Process isn\'t alive but didn\'t join in time...')